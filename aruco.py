@@ -1,66 +1,286 @@
 import cv2.cv2 as cv2
-from math import radians, tanh, pi
+import numpy as np
+from collections.abc import Mapping
+from math import atan2, degrees, log2, floor
 from calibresults import camera_matrix, dist_coeff
+from metrics import span
 
 CAMERA_HEIGHT, CAMERA_WIDTH = 720, 960
 CAMERA_VFOV = 43
 CAMERA_HFOV = 60
 MARKER_HEIGHT, MARKER_WIDTH = 100, 100
+MIN_MARKER_SIZE = 40  # Smallest marker side length (pixels) to detect reliably at a pyramid level
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+FLOW_PARAMETERS = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+
+class MarkerSet:
+    """The markers found in one frame, held in arrays with one row per marker."""
+    __slots__ = ('ids', 'corners', 'centres', 'sizes', 'rvecs', 'tvecs', 'distances', '_index')
+
+    def __init__(self, corners=(), ids=None):
+        count = 0 if ids is None else len(ids)
+        self.ids = np.empty(0, dtype=np.int32) if ids is None else np.asarray(ids, dtype=np.int32).reshape(-1)
+        self.corners = np.concatenate(corners).reshape(-1, 4, 2).astype(np.float32, copy=False) if count else np.empty((0, 4, 2), np.float32)
+        self.centres = self.corners.mean(axis=1)
+        self.sizes = np.ptp(self.corners, axis=1).max(axis=1)  # Longest side of the bounding box, pixels
+        self.rvecs = np.zeros((count, 3))  # Rotation of each marker
+        self.tvecs = np.zeros((count, 3))  # Translation (mm) of each marker from the camera
+        self.distances = np.zeros(count)
+        self._index = {marker_id: row for row, marker_id in enumerate(self.ids.tolist())}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, marker_id):
+        return marker_id in self._index
+
+    def row(self, marker_id):
+        """The row of the marker with id `marker_id`. Raises KeyError if it was not found."""
+        return self._index[marker_id]
+
+    def set_poses(self, rvecs, tvecs):
+        """Store the pose of each marker, as returned by estimatePoseSingleMarkers."""
+        self.rvecs = rvecs.reshape(-1, 3)
+        self.tvecs = tvecs.reshape(-1, 3)
+        self.distances = np.linalg.norm(self.tvecs, axis=1)
+
+
+class MarkerView(Mapping):
+    """Read only dict of marker id to one value from a MarkerSet, for code written against the old dicts."""
+    __slots__ = ('_markers', '_value')
+
+    def __init__(self, markers, value):
+        self._markers = markers
+        self._value = value
+
+    def __getitem__(self, marker_id):
+        return self._value(self._markers, self._markers.row(marker_id))
+
+    def __iter__(self):
+        return iter(self._markers._index)
+
+    def __len__(self):
+        return len(self._markers)
+
+    def __repr__(self):
+        return repr(dict(self))
+
 
 class Tracker:
-    """Aruco tracking."""
-    def __init__(self):
+    """Aruco tracking.
+    In incremental mode markers seen in the previous frame are only searched for in a padded region of interest (ROI)
+    around where they are predicted to be. The whole frame is scanned every `full_scan_interval` frames, and whenever
+    a tracked marker is lost.
+    In pyramid mode markers are detected on a copy of the image downscaled by 2**`level`, and the corners are then
+    refined on the full resolution image. The level is chosen from the smallest marker seen in the last frame, so
+    near (large) markers are found on a coarse level and far (small) markers at full resolution.
+    In flow mode the corners of known markers are tracked from frame to frame with pyramidal Lucas-Kanade optical flow,
+    and markers are only detected every `redetect_interval` frames, or when a marker fails the forward-backward flow
+    check. Markers that a detection misses are filled in from optical flow until the next detection.
+    If given `metrics`, detection and pose estimation are timed as the 'detect' and 'pose' stages.
+    If given `undistort`, an `undistort.UndistortMap`, the corners are undistorted through its lookup table before
+    the pose is estimated, rather than by OpenCV's iterative undistortion inside the pose estimate.
+    The pose of every marker is estimated once per `update`. Set `debug_hook` to a function taking
+    (ids, rvecs, tvecs) to inspect the poses as they are estimated."""
+    def __init__(self, incremental=False, full_scan_interval=10, roi_padding=0.5, pyramid=False, max_level=2,
+                 flow=False, redetect_interval=5, max_flow_error=1.0, metrics=None, undistort=None):
         self.aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
         self.parameters =  cv2.aruco.DetectorParameters_create()
         self.parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
-        self.markers = {}
-        self.centres = {}
-        self.distances = {}
-        self._corners = None
-        self._marker_ids = None
-
-    @staticmethod
-    def _calc_distance(corners):
-        """Calculate the distance to a marker.
-        Assumes target is perpendicular to camera axis, and far enough away that right-angle geometry is accurate enough."""
-        angle = radians(CAMERA_HFOV) / CAMERA_WIDTH * (corners[1][0] - corners[0][0])
-        return round(MARKER_WIDTH / tanh(angle))
+        self.coarse_parameters = cv2.aruco.DetectorParameters_create()  # Corners are refined at full resolution instead
+        self.incremental = incremental
+        self.full_scan_interval = full_scan_interval
+        self.roi_padding = roi_padding  # ROI padding on each side, as a fraction of the marker size
+        self.pyramid = pyramid
+        self.max_level = max_level
+        self.flow = flow
+        self.redetect_interval = redetect_interval
+        self.max_flow_error = max_flow_error  # Largest forward-backward flow error (pixels) of a tracked corner
+        self.debug_hook = None
+        self.metrics = metrics
+        self.undistort = undistort
+        self.reset()
+
+    def reset(self):
+        """Forget the markers seen so far, so the next update scans the whole frame."""
+        self.level = 0
+        self.marker_set = MarkerSet()
+        self._previous = MarkerSet()  # Markers of the frame before, to predict motion
+        self._frames_since_scan = 0
+        self._frames_since_detection = 0
+        self._previous_gray = None
+        self._anchored = set()  # Ids found by the last detection, which may be filled in by flow if detection drops them
+
+    def warm_up(self, width=960, height=720):
+        """Detect and estimate the pose of a marker drawn on a blank frame, untimed, then forget it.
+        This does OpenCV's one off setup, and pages in the undistortion table, before the first real frame."""
+        image = np.full((height, width), 255, dtype=np.uint8)
+        size = height // 4
+        top, left = (height - size) // 2, (width - size) // 2
+        image[top:top + size, left:left + size] = cv2.aruco.drawMarker(self.aruco_dict, 0, size)
+        metrics, debug_hook = self.metrics, self.debug_hook
+        self.metrics = self.debug_hook = None
+        try:
+            self.update(image)
+        finally:
+            self.metrics, self.debug_hook = metrics, debug_hook
+            self.reset()
+
+    @property
+    def markers(self):
+        """Corners of each marker, as a read only dict of marker id to a list of four (x, y) tuples."""
+        return MarkerView(self.marker_set, lambda m, row: [tuple(xy) for xy in m.corners[row].tolist()])
+
+    @property
+    def centres(self):
+        """Centre of each marker, as a read only dict of marker id to (x, y) in whole pixels."""
+        return MarkerView(self.marker_set, lambda m, row: tuple(int(v) for v in m.centres[row].round()))
+
+    @property
+    def distances(self):
+        """Distance to each marker, as a read only dict of marker id to millimeters."""
+        return MarkerView(self.marker_set, lambda m, row: round(m.distances[row]))
+
+    def _choose_level(self):
+        """Choose the pyramid level at which the smallest marker seen is still at least `MIN_MARKER_SIZE` pixels."""
+        if not self.pyramid or not len(self.marker_set):
+            return 0
+        size = self.marker_set.sizes.min()
+        return max(0, min(self.max_level, floor(log2(max(size, 1) / MIN_MARKER_SIZE))))
+
+    def _detect(self, gray):
+        """Detect markers at the current pyramid level. Returns (corners, ids) in the coordinates of `gray`."""
+        if self.level == 0:
+            return cv2.aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)[:2]
+        scale = 2 ** self.level
+        small = cv2.resize(gray, (gray.shape[1] // scale, gray.shape[0] // scale), interpolation=cv2.INTER_AREA)
+        corners, ids, _ = cv2.aruco.detectMarkers(small, self.aruco_dict, parameters=self.coarse_parameters)
+        if ids is None:
+            return corners, ids
+        window = (scale + 2, scale + 2)
+        refined = []
+        for c in corners:
+            c = ((c + 0.5) * scale - 0.5).reshape(-1, 1, 2)
+            c = cv2.cornerSubPix(gray, c, window, (-1, -1), SUBPIX_CRITERIA)
+            refined.append(c.reshape(1, 4, 2))
+        return refined, ids
 
     def update(self, image):
-        """Given an image, detect all markers in the image."""
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        self._corners, self._marker_ids, rejected_points = cv2.aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)
-        self.markers = {}
-        self.centres = {}
-        self.distances = {}
-        if self._marker_ids is None:
-            return
-        for i in range(len(self._marker_ids)):
-            marker_id = self._marker_ids[i][0]
-            c = self._corners[i][0]
-            self.centres[marker_id] = (round(c[:, 0].mean()), round(c[:, 1].mean()))
-            c = [ tuple(xy) for xy in c.tolist() ]
-            self.markers[marker_id] = c
-            self.distances[marker_id] = self._calc_distance(c)
-
-    def draw_markers(self, image):
-        """Draw the detected markers on an image. Assumed to be the same image that `update` was run on."""
-        for marker_id, d in self.distances.items():
-            x = int(self.markers[marker_id][1][0]) + 5
-            y = int(self.markers[marker_id][1][1]) + 5
-            s = 'd=%s' % d
-            cv2.putText(image, s, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 255, 255), 1, cv2.LINE_AA)
-        return cv2.aruco.drawDetectedMarkers(image, self._corners, self._marker_ids)
-
-    def draw_axes(self, image):
-        """Draw the xyz markers on the image."""
-        if self._marker_ids is None:
+        """Given an image, detect all markers in the image.
+        A grayscale image is used as is, a BGR image is converted first."""
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        with span(self.metrics, 'detect'):
+            detected = None
+            if self.flow and len(self.marker_set) and self._frames_since_detection < self.redetect_interval:
+                ids = self.marker_set.ids.tolist()
+                detected = self._track_flow(gray, ids)
+                if len(detected[1]) < len(ids):
+                    detected = None  # A marker failed the flow check, so re-anchor with a detection
+            if detected is None:
+                detected = self._detect_markers(gray)
+                self._frames_since_detection = 0
+            else:
+                self._frames_since_detection += 1
+        self._previous_gray = gray
+        self._previous = self.marker_set
+        self.marker_set = MarkerSet(*detected)
+        if len(self.marker_set):
+            with span(self.metrics, 'pose'):
+                if self.undistort:
+                    corners = self.undistort.points(self.marker_set.corners)
+                    rvecs, tvecs, _ = cv2.aruco.estimatePoseSingleMarkers(corners, MARKER_HEIGHT, camera_matrix, None)
+                else:
+                    rvecs, tvecs, _ = cv2.aruco.estimatePoseSingleMarkers(self.marker_set.corners, MARKER_HEIGHT, camera_matrix, dist_coeff)
+                self.marker_set.set_poses(rvecs, tvecs)
+            if self.debug_hook:
+                self.debug_hook(self.marker_set.ids, self.marker_set.rvecs, self.marker_set.tvecs)
+        self.level = self._choose_level()
+
+    def _detect_markers(self, gray):
+        """Detect markers, in ROIs if incremental, else in the whole frame.
+        In flow mode markers missed by the detection are filled in with optical flow."""
+        detected = None
+        if self.incremental and len(self.marker_set) and self._frames_since_scan < self.full_scan_interval:
+            detected = self._detect_rois(gray)
+        if detected is None:
+            detected = self._detect(gray)
+            self._frames_since_scan = 0
+        else:
+            self._frames_since_scan += 1
+        if not self.flow:
+            return detected
+        corners, ids = detected
+        corners, ids = list(corners), [] if ids is None else np.ravel(ids).tolist()
+        missing = [marker_id for marker_id in self._anchored if marker_id not in ids and marker_id in self.marker_set]
+        self._anchored = set(ids)
+        if missing:
+            flow_corners, flow_ids = self._track_flow(gray, missing)
+            corners.extend(flow_corners)
+            ids.extend(flow_ids)
+        return corners, ids
+
+    def _track_flow(self, gray, ids):
+        """Track the corners of the markers `ids` from the last frame with optical flow.
+        Returns (corners, ids) of the markers whose corners all pass the forward-backward check."""
+        rows = [self.marker_set.row(marker_id) for marker_id in ids]
+        points = self.marker_set.corners[rows].reshape(-1, 1, 2)
+        tracked, status, _ = cv2.calcOpticalFlowPyrLK(self._previous_gray, gray, points, None, **FLOW_PARAMETERS)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self._previous_gray, tracked, None, **FLOW_PARAMETERS)
+        error = np.linalg.norm(points - back, axis=2).reshape(-1, 4).max(axis=1)
+        ok = (status & back_status).reshape(-1, 4).all(axis=1) & (error < self.max_flow_error)
+        tracked = tracked.reshape(-1, 4, 2)
+        ok &= np.array([cv2.isContourConvex(c) for c in tracked])
+        return list(tracked[ok].reshape(-1, 1, 4, 2)), np.array(ids)[ok].tolist()
+
+    def _predict(self, marker_id):
+        """Predict where the corners of a marker will be in this frame, assuming it keeps moving as it did."""
+        corners = self.marker_set.corners[self.marker_set.row(marker_id)]
+        if marker_id in self._previous:
+            return 2 * corners - self._previous.corners[self._previous.row(marker_id)]
+        return corners
+
+    def _detect_rois(self, gray):
+        """Detect markers only in a padded ROI around each marker seen in the last frame.
+        Returns (corners, ids) in full frame coordinates, or None if any of the markers was lost."""
+        height, width = gray.shape[:2]
+        corners, ids = [], []
+        for marker_id in self.marker_set.ids.tolist():
+            if marker_id in ids:
+                continue  # Already found in the ROI of a neighbouring marker
+            c = self._predict(marker_id)
+            (x0, y0), (x1, y1) = c.min(axis=0), c.max(axis=0)
+            pad = self.roi_padding * max(x1 - x0, y1 - y0) + 10
+            x0, y0 = max(int(x0 - pad), 0), max(int(y0 - pad), 0)
+            x1, y1 = min(int(x1 + pad) + 1, width), min(int(y1 + pad) + 1, height)
+            if x1 <= x0 or y1 <= y0:
+                return None  # Predicted to have left the frame
+            roi_corners, roi_ids = self._detect(gray[y0:y1, x0:x1])
+            if roi_ids is None:
+                return None
+            for roi_c, roi_id in zip(roi_corners, roi_ids[:, 0]):
+                if roi_id not in ids:
+                    corners.append(roi_c + np.array([x0, y0], dtype=np.float32))
+                    ids.append(int(roi_id))
+            if marker_id not in ids:
+                return None
+        return corners, ids
+
+    def draw_markers(self, image, markers=None):
+        """Draw the detected markers on an image. Assumed to be the same image that `update` was run on, or that
+        `markers`, a MarkerSet kept from an earlier `update`, was found in."""
+        markers = self.marker_set if markers is None else markers
+        if not len(markers):
             return image
-        rvecs, tvecs, _ = cv2.aruco.estimatePoseSingleMarkers(self._corners, MARKER_HEIGHT , camera_matrix, dist_coeff)
-        print('rvecs', (rvecs*180/pi).round(), 'tvecs', tvecs.round())
-        image = cv2.aruco.drawDetectedMarkers(image, self._corners, self._marker_ids)
-        for i in range(len(tvecs)):
-            image = cv2.aruco.drawAxis(image, camera_matrix, dist_coeff, rvecs[i], tvecs[i], MARKER_HEIGHT)
+        for (x, y), d in zip(markers.corners[:, 1].astype(int).tolist(), markers.distances.round().astype(int).tolist()):
+            cv2.putText(image, 'd=%s' % d, (x + 5, y + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 255, 255), 1, cv2.LINE_AA)
+        return cv2.aruco.drawDetectedMarkers(image, markers.corners.reshape(-1, 1, 4, 2), markers.ids.reshape(-1, 1))
+
+    def draw_axes(self, image, markers=None):
+        """Draw the xyz axes of each marker, from the poses estimated in `update` or those in `markers`."""
+        markers = self.marker_set if markers is None else markers
+        for rvec, tvec in zip(markers.rvecs, markers.tvecs):
+            image = cv2.aruco.drawAxis(image, camera_matrix, dist_coeff, rvec, tvec, MARKER_HEIGHT)
         return image
 
     def calc_error(self, marker_id, reticle):
@@ -69,19 +289,21 @@ class Tracker:
         If error_x > 0 then the centre of the marker is to the right of x
         If error_y > 0 then the centre of the marker is above y
         Recall that for images (0,0) is the top left corner.
+        The angle is the yaw of the marker in degrees, positive when its left edge is closer than its right edge.
         """
-        if marker_id not in self.centres:
+        if marker_id not in self.marker_set:
             return 0, 0, 0
+        row = self.marker_set.row(marker_id)
+        tx, ty, tz = self.marker_set.tvecs[row]
+        # Project the reticle out to the depth of the marker
         x, y = reticle
-        error_x_px = self.centres[marker_id][0] - x
-        error_y_px = y - self.centres[marker_id][1]
-        c = self.markers[marker_id]
-        width_px = c[1][0] - c[0][0]
-        height_px = c[2][1] - c[1][1]
-        error_x = MARKER_WIDTH / width_px * error_x_px
-        error_y = MARKER_HEIGHT / height_px * error_y_px
-        angle = (c[3][1] - c[0][1]) - (c[2][1] - c[1][1])  # Not really the angle, just proportional to the angle. TODO get correct angle
-        angle *= 10  # Fudge factor
+        reticle_x = (x - camera_matrix[0, 2]) / camera_matrix[0, 0] * tz
+        reticle_y = (y - camera_matrix[1, 2]) / camera_matrix[1, 1] * tz
+        error_x = tx - reticle_x
+        error_y = reticle_y - ty
+        rotation, _ = cv2.Rodrigues(self.marker_set.rvecs[row])
+        normal = rotation[:, 2]  # Marker z axis, points out of the marker towards the camera
+        angle = degrees(atan2(normal[0], -normal[2]))
         return error_x, error_y, angle
 
 
@@ -0,0 +1,185 @@
+"""
+Benchmark the vision and control pipeline on synthetic frames, with no drone.
+
+Renders 960x720 frames of DICT_4X4_50 markers with `scene`, then times each stage of the pipeline in `fly.py` on
+them, and reports the 50th and 99th percentile latency and the throughput of each.
+
+Usage:
+python bench.py
+python bench.py --distance 3000 --count 20 --yaw 30 --blur 1.5 --frames 300
+"""
+
+import argparse
+import os
+import time
+import av
+import cv2.cv2 as cv2
+import numpy as np
+from simple_pid import PID
+import scene
+from aruco import MARKER_HEIGHT, Tracker
+from calibresults import camera_matrix, dist_coeff
+from detection import ArucoDetector, ColourDetector, DetectionEngine
+from fly import calc_gluideslope, draw_horizon, draw_hud, draw_reticle, hud_rows
+from hud import Hud
+from recorder import FlightData
+from telemetry import FLIGHT_DTYPE, FLIGHT_FIELDS, make_row
+from tracker import ColourTracker, Tracker as SingleColourTracker
+from undistort import UndistortMap
+from video import Frame
+
+# Tracker settings compared by the benchmark
+DETECTION_MODES = {
+    'full': {},
+    'incremental': {'incremental': True},
+    'pyramid': {'pyramid': True},
+    'flow': {'flow': True},
+    'all': {'incremental': True, 'pyramid': True, 'flow': True},
+}
+BLUE_LOWER, BLUE_UPPER = (110, 50, 50), (130, 255, 255)
+GREEN_LOWER, GREEN_UPPER = (50, 50, 50), (70, 255, 255)
+FLIGHT_DATA = make_row(FLIGHT_DTYPE, 0.0, (FLIGHT_FIELDS, FlightData(height=12, ground_speed=3, battery_percentage=80,
+                                                                    wifi_strength=90, camera_state=0, fly_mode=6)))
+
+
+def timed(function, items):
+    """Call `function` on each of `items` in turn, returning the seconds each call took."""
+    times = np.empty(len(items))
+    for i, item in enumerate(items):
+        start = time.perf_counter()
+        function(item)
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def report(name, times):
+    """Print a line of latency percentiles and throughput."""
+    p50, p99 = np.percentile(times, [50, 99]) * 1000
+    print('%-22s p50 %7.2f ms   p99 %7.2f ms   %8.1f /s' % (name, p50, p99, len(times) / times.sum()))
+
+
+def yuv_frames(images):
+    """Encode-side stand in for decoded video: the BGR images as yuv420p PyAV frames."""
+    return [av.VideoFrame.from_ndarray(image, format='bgr24').reformat(format='yuv420p') for image in images]
+
+
+def colour_frames(images):
+    """The images with a blue ball drawn on them, moving across the frame."""
+    frames = []
+    for i, image in enumerate(images):
+        image = image.copy()
+        cv2.circle(image, (200 + 4 * (i % 100), 500), 40, (200, 60, 30), -1)
+        frames.append(image)
+    return frames
+
+
+def pooled(engine, images):
+    """Detect in `images` on `engine`, keeping it full. Returns the seconds from submit to result of each frame,
+    and the seconds for all of them."""
+    submitted, latencies = {}, []
+
+    def collect():
+        sequence, _ = engine.result()
+        latencies.append(time.perf_counter() - submitted.pop(sequence))
+
+    start = time.perf_counter()
+    for image in images:
+        if engine.in_flight >= engine.max_in_flight:
+            collect()
+        submitted[engine.submit(image)] = time.perf_counter()
+    while engine.in_flight:
+        collect()
+    return np.array(latencies), time.perf_counter() - start
+
+
+def main():
+    arg_parse = argparse.ArgumentParser()
+    arg_parse.add_argument('--frames', type=int, default=200, help='frames per scene')
+    arg_parse.add_argument('--distance', type=float, default=1500, help='distance to the markers (mm)')
+    arg_parse.add_argument('--count', type=int, default=1, help='number of markers in view, at most %d' % scene.MARKER_IDS)
+    arg_parse.add_argument('--yaw', type=float, default=0, help='rotation of the markers (degrees)')
+    arg_parse.add_argument('--blur', type=float, default=0.8, help='blur sigma (pixels)')
+    arg_parse.add_argument('--noise', type=float, default=2, help='pixel noise standard deviation')
+    args = arg_parse.parse_args()
+    if not 1 <= args.count <= scene.MARKER_IDS:
+        arg_parse.error('--count must be from 1 to %d, the markers in the dictionary' % scene.MARKER_IDS)
+
+    print('Rendering %d frames: %d marker(s) at %d mm, yaw %d, blur %.1f, noise %.1f' %
+          (args.frames, args.count, args.distance, args.yaw, args.blur, args.noise))
+    images = scene.sequence(args.frames, args.distance, args.count, args.yaw, args.blur, args.noise)
+    decoded = yuv_frames(images)
+
+    report('convert: to_image', timed(lambda f: cv2.cvtColor(np.array(f.to_image()), cv2.COLOR_RGB2BGR), decoded))
+    report('convert: Frame.gray', timed(lambda f: Frame(f).gray, decoded))
+    report('convert: Frame.bgr', timed(lambda f: Frame(f).bgr, decoded))
+
+    grays = [Frame(f).gray for f in decoded]
+    for mode, options in DETECTION_MODES.items():
+        tracker = Tracker(**options)
+        times = timed(tracker.update, grays)
+        report('detect: %s' % mode, times)
+        print('%-22s %d of %d markers in the last frame' % ('', len(tracker.marker_set), args.count))
+
+    tracker = Tracker()
+    tracker.update(grays[-1])
+    corners = tracker.marker_set.corners
+    undistort = UndistortMap.load()
+    report('pose: OpenCV undistort', timed(
+        lambda c: cv2.aruco.estimatePoseSingleMarkers(c, MARKER_HEIGHT, camera_matrix, dist_coeff), [corners] * len(grays)))
+    report('pose: lookup table',
+           timed(lambda c: cv2.aruco.estimatePoseSingleMarkers(undistort.points(c), MARKER_HEIGHT, camera_matrix, None),
+                 [corners] * len(grays)))
+
+    reticle = calc_gluideslope(-5)
+    hud = Hud(lambda image: draw_reticle(draw_horizon(image), reticle), images[0].shape[1], images[0].shape[0])
+
+    def draw(image):
+        tracker.update(image)
+        image = image.copy()
+        start = time.perf_counter()
+        tracker.draw_markers(image)
+        draw.markers.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        tracker.draw_axes(image)
+        draw.axes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        draw_reticle(image, reticle)
+        draw_hud(image, True, FLIGHT_DATA)
+        draw.hud.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        hud.draw(image, hud_rows(True, FLIGHT_DATA))
+        draw.compositor.append(time.perf_counter() - start)
+    draw.markers, draw.axes, draw.hud, draw.compositor = [], [], [], []
+    for image in images:
+        draw(image)
+    report('draw_markers', np.array(draw.markers))
+    report('draw_axes', np.array(draw.axes))
+    report('draw_hud', np.array(draw.hud))
+    report('draw_hud: compositor', np.array(draw.compositor))
+
+    controls = [PID(-0.08, -0.007, -0.003, setpoint=0, sample_time=None) for _ in range(3)]
+    errors = np.random.default_rng(0).normal(0, 100, (args.frames, 3))
+    report('pid: 3 axes', timed(lambda e: [control(v) for control, v in zip(controls, e)], errors))
+
+    balls = colour_frames(images)
+    height, width = images[0].shape[:2]
+    colour = SingleColourTracker(height, width, BLUE_LOWER, BLUE_UPPER)
+    report('colour tracker', timed(lambda image: colour.track(image.copy()), balls))
+    colours = ColourTracker(height, width, {'blue': (BLUE_LOWER, BLUE_UPPER), 'green': (GREEN_LOWER, GREEN_UPPER)})
+    report('colour: 2 colours', timed(colours.track, balls))
+
+    serial = [ArucoDetector(), ColourDetector(BLUE_LOWER, BLUE_UPPER)]
+    report('both: serial', timed(lambda image: [detector(image) for detector in serial], balls))
+    detectors = {'markers': ('aruco', {}), 'ball': ('colour', {'lower': BLUE_LOWER, 'upper': BLUE_UPPER})}
+    for in_flight in (1, 2, 4):
+        with DetectionEngine(detectors, max_in_flight=in_flight) as engine:
+            pooled(engine, balls[:engine.workers])  # Start the workers
+            latencies, total = pooled(engine, balls)
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print('%-22s p50 %7.2f ms   p99 %7.2f ms   %8.1f /s' %
+              ('both: pool, %d in flight' % in_flight, p50, p99, len(balls) / total))
+    print('%-22s %d workers' % ('', os.cpu_count()))
+
+
+if __name__ == '__main__':
+    main()
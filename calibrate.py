@@ -1,16 +1,41 @@
 """
-Connect to the drone and calibrate the camera
+Calibrate the camera from views of a ChArUco board
+
+Views can come from the drone, a recorded video (a video file, or a recording made with `fly.py --record`), or a
+folder of images:
+    python calibrate.py
+    python calibrate.py --video calibration.tello
+    python calibrate.py --images calibration/
+
+Corners are extracted from recorded frames on all cores. A coverage index keeps a view only while the image regions
+its corners fall in, or its board pose, have fewer than `--per-bin` views, so the solve gets a spread of views rather
+than many near copies of the same one. The result is written as a versioned intrinsics file, intrinsics.json by
+default, which `calibresults` loads, and so `aruco` and the rest use it from then on.
+
+Press q to stop capturing from the drone and calibrate. With --headless there is no window, so press q in the --preview
+window, or Ctrl-C.
 """
 
-import time
+import argparse
+import glob
+import os
+from math import atan2, degrees
+from multiprocessing import Pool
 import tellopy
 import av
 import cv2.cv2 as cv2  # for avoidance of pylint error
 from cv2 import aruco
 import numpy as np
+import calibresults
+from recorder import MAGIC, ReplayDrone
+from video import Frame, FrameGrabber, open_video
+from viewer import add_viewer_arguments, make_viewer
 
 aruco_dict = aruco.Dictionary_get(aruco.DICT_4X4_50)
 board = aruco.CharucoBoard_create(7, 5, 1, .8, aruco_dict)
+criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.00001)  # Subpixel corner detection criteria
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+MIN_CORNERS = 6  # Fewest ChArUco corners for a view to be used, the solve needs six
 
 def make_chessboard():
     """Make a "chess" aruco board, and save to file for printing."""
@@ -18,6 +43,81 @@ def make_chessboard():
     cv2.imwrite('chessboard.tiff', imboard)
 
 
+def extract_corners(image):
+    """Find the ChArUco corners in a grayscale image, to sub pixel accuracy.
+    Returns (corners, ids), or None if too few corners were found."""
+    corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(image, aruco_dict)
+    if len(corners) == 0:
+        return None
+    # SUB PIXEL DETECTION
+    for corner in corners:
+        cv2.cornerSubPix(image, corner,
+                         winSize = (3,3),
+                         zeroZone = (-1,-1),
+                         criteria = criteria)
+    res2 = cv2.aruco.interpolateCornersCharuco(corners, ids, image, board)
+    if res2[1] is None or res2[2] is None or len(res2[1]) < MIN_CORNERS:
+        return None
+    return res2[1], res2[2]
+
+
+class CoverageIndex:
+    """Counts of the views kept, by image region and by board pose.
+    The image is divided into a `grid` of (columns, rows) regions. The board pose is binned by its tilt about the
+    camera's x and y axes, in `angle_step` degree steps, and by its distance, in doublings. The pose comes from the
+    current calibration, which only needs to be roughly right to bin views."""
+    def __init__(self, image_size, grid=(4, 3), angle_step=15, per_bin=3):
+        self.image_size = image_size  # (width, height)
+        self.grid = grid
+        self.angle_step = angle_step
+        self.per_bin = per_bin  # Views wanted in each region and pose bin
+        self.regions = np.zeros(grid[::-1], dtype=int)
+        self.poses = {}
+        self.offered = 0
+        self.kept = 0
+
+    def _regions(self, corners):
+        """The (row, column) of each region with a corner in it."""
+        points = corners.reshape(-1, 2)
+        columns = np.clip((points[:, 0] * self.grid[0] / self.image_size[0]).astype(int), 0, self.grid[0] - 1)
+        rows = np.clip((points[:, 1] * self.grid[1] / self.image_size[1]).astype(int), 0, self.grid[1] - 1)
+        return set(zip(rows.tolist(), columns.tolist()))
+
+    def _pose_bin(self, corners, ids):
+        """(tilt x, tilt y, distance) bin of the board, or None if its pose cannot be estimated."""
+        found, rvec, tvec = cv2.aruco.estimatePoseCharucoBoard(corners, ids, board, calibresults.camera_matrix,
+                                                               calibresults.dist_coeff, None, None)
+        if not found:
+            return None
+        normal = cv2.Rodrigues(rvec)[0][:, 2]
+        tilt_x = degrees(atan2(normal[1], -normal[2]))
+        tilt_y = degrees(atan2(normal[0], -normal[2]))
+        distance = float(np.linalg.norm(tvec))
+        return (int(tilt_x // self.angle_step), int(tilt_y // self.angle_step),
+                int(np.floor(np.log2(max(distance, 1e-3)))))
+
+    def add(self, corners, ids):
+        """Count the view and return True if it covers a region or pose bin that has too few views yet.
+        Otherwise return False, and the view should be dropped."""
+        self.offered += 1
+        regions = self._regions(corners)
+        pose = self._pose_bin(corners, ids)
+        informative = any(self.regions[region] < self.per_bin for region in regions)
+        informative = informative or (pose is not None and self.poses.get(pose, 0) < self.per_bin)
+        if not informative:
+            return False
+        for region in regions:
+            self.regions[region] += 1
+        if pose is not None:
+            self.poses[pose] = self.poses.get(pose, 0) + 1
+        self.kept += 1
+        return True
+
+    def __str__(self):
+        return ('%d of %d views kept, %d pose bins, regions with fewest views: %d' %
+                (self.kept, self.offered, len(self.poses), self.regions.min()))
+
+
 def calibrate_camera(allCorners,allIds,imsize):
     """Calibrates the camera using the dected corners."""
     print("CAMERA CALIBRATION")
@@ -40,87 +140,148 @@ def calibrate_camera(allCorners,allIds,imsize):
                       cameraMatrix=cameraMatrixInit,
                       distCoeffs=distCoeffsInit,
                       flags=flags,
-                      criteria=(cv2.TERM_CRITERIA_EPS & cv2.TERM_CRITERIA_COUNT, 10000, 1e-9))
+                      criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 1000, 1e-9))
 
     return ret, camera_matrix, distortion_coefficients0, rotation_vectors, translation_vectors
 
 
-def main():
-    drone = tellopy.Tello()
-    drone.connect()
-    drone.wait_for_connection(60.0)
+def video_frames(path, step=5):
+    """Every `step`th frame of a video file or a recording, as grayscale images."""
+    with open(path, 'rb') as f:
+        is_recording = f.read(len(MAGIC)) == MAGIC
+    container = av.open(ReplayDrone(path).get_video_stream() if is_recording else path)
+    for i, frame in enumerate(container.decode(video=0)):
+        if i % step == 0:
+            yield Frame(frame).gray.copy()
+
 
-    retry = 3
-    container = None
-    while container is None and 0 < retry:
-        retry -= 1
-        try:
-            container = av.open(drone.get_video_stream())
-        except av.AVError as ave:
-            print(ave)
-            print('retry...')
+def image_frames(folder):
+    """The images in a folder, in name order, as grayscale images."""
+    for path in sorted(glob.glob(os.path.join(folder, '*'))):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if image is not None:
+                yield image
 
+
+def select_views(frames, workers=None, per_bin=3):
+    """Extract the corners from `frames` on `workers` processes (one per core by default), and keep the informative
+    views. Returns the corners and ids of each view kept, the image size, and the coverage index."""
     allCorners = []
     allIds = []
-    decimator = 0
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.00001)  # Subpixel corner detection criteria
-
-    capture_images = True
-    frame_skip = 300  # Skip first frames
-    while capture_images:
-        for frame in container.decode(video=0):
-            # If transforms are taking too long then start skipping frames
-            if frame_skip > 0:
-                frame_skip -= 1
+    index = None
+    imsize = None
+
+    def sized(frames):
+        # Note the image size from the first frame on the way past
+        nonlocal imsize
+        for image in frames:
+            if imsize is None:
+                imsize = (image.shape[1], image.shape[0])
+            yield image
+
+    with Pool(workers) as pool:
+        for view in pool.imap(extract_corners, sized(frames), chunksize=4):
+            if view is None:
                 continue
-            start_time = time.time()
-            image = cv2.cvtColor(np.array(frame.to_image()), cv2.COLOR_BGR2GRAY)
-            corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(image, aruco_dict)
+            if index is None:
+                index = CoverageIndex(imsize, per_bin=per_bin)
+            if index.add(*view):
+                allCorners.append(view[0])
+                allIds.append(view[1])
+    return allCorners, allIds, imsize, index
 
-            if len(corners)>0:
-                # SUB PIXEL DETECTION
-                for corner in corners:
-                    cv2.cornerSubPix(image, corner,
-                                     winSize = (3,3),
-                                     zeroZone = (-1,-1),
-                                     criteria = criteria)
-                res2 = cv2.aruco.interpolateCornersCharuco(corners, ids, image, board)
-                if res2[1] is not None and res2[2] is not None and len(res2[1]) > 3 and decimator%1 == 0:
-                    allCorners.append(res2[1])
-                    allIds.append(res2[2])
 
-            decimator+=1
+def capture_views(headless=False, viewer=None, per_bin=3):
+    """Capture views of the board from the drone, until q is pressed.
+    If `headless` no window is opened. The frames go to `viewer`, a `viewer.Viewer`, if given."""
+    if viewer:
+        viewer.start()
+    drone = tellopy.Tello()
+    drone.connect()
+    drone.wait_for_connection(60.0)
+    grabber = FrameGrabber(open_video(drone.get_video_stream()), low_latency=True).start()
+
+    allCorners = []
+    allIds = []
+    index = None
+    image = None
+
+    try:
+        while grabber.running:
+            # The grabber keeps only the newest frame, and sheds decoding while corners are being extracted
+            frame = grabber.read(0.1)
+            if frame is None:
+                continue
+            image = frame.gray
+            view = extract_corners(image)
+            if view is not None:
+                if index is None:
+                    index = CoverageIndex((image.shape[1], image.shape[0]), per_bin=per_bin)
+                if index.add(*view):
+                    allCorners.append(view[0])
+                    allIds.append(view[1])
+                    print(index)
 
 
             # Key presses give the drone a speed, and not a distance to move. Press x to stop all movement
-            key = cv2.waitKey(1) & 0xFF
+            key = viewer.key() if viewer else 255
+            if not headless:
+                window_key = cv2.waitKey(1) & 0xFF
+                key = window_key if window_key != 255 else key  # Either window can quit
             if key == ord('q'):
-                capture_images = False
                 break
 
             # Display image
-            cv2.imshow('Drone', image)
-
-            # Determine if need to skip any frames
-            if frame.time_base < 1.0/60:
-                time_base = 1.0/60
-            else:
-                time_base = frame.time_base
-            frame_skip = int((time.time() - start_time)/time_base)
-            frame_skip += 30
-            print('.',)
-
-    # Done with calibration
+            if viewer:
+                viewer.show(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+            if not headless:
+                cv2.imshow('Drone', image)
+    except KeyboardInterrupt:
+        pass
+
+    # Done with capturing
+    grabber.stop()
     drone.quit()
-    cv2.destroyAllWindows()
-    imsize = image.shape
+    if viewer:
+        viewer.stop()
+    if not headless:
+        cv2.destroyAllWindows()
+    imsize = (image.shape[1], image.shape[0]) if image is not None else None
+    return allCorners, allIds, imsize, index
+
+
+def main(video=None, images=None, output=calibresults.INTRINSICS_PATH, workers=None, step=5, per_bin=3,
+         headless=False, viewer=None):
+    """Calibrate from a video or recording, a folder of images, or else the drone, and save the intrinsics."""
+    if video:
+        allCorners, allIds, imsize, index = select_views(video_frames(video, step), workers, per_bin)
+    elif images:
+        allCorners, allIds, imsize, index = select_views(image_frames(images), workers, per_bin)
+    else:
+        allCorners, allIds, imsize, index = capture_views(headless, viewer, per_bin)
+    print(index or 'No views of the board found')
+    if not allCorners:
+        return
+
     ret, mtx, dist, rvecs, tvecs = calibrate_camera(allCorners, allIds, imsize)
     print('ret', ret)
     print('mtx', mtx)
     print('dist', dist)
-    print('rvect', rvecs)
-    print('tvect', tvecs)
+    calibresults.save_intrinsics(output, mtx, dist, imsize, rms=ret, views=len(allCorners),
+                                 source=video or images or 'drone')
+    print('Saved to', output)
 
 
 if __name__ == '__main__':
-    main()
+    arg_parse = argparse.ArgumentParser()
+    arg_parse.add_argument('--video', help='calibrate from a video file or recording, instead of the drone')
+    arg_parse.add_argument('--images', help='calibrate from a folder of images, instead of the drone')
+    arg_parse.add_argument('--output', default=calibresults.INTRINSICS_PATH, help='intrinsics file to write')
+    arg_parse.add_argument('--workers', type=int, help='corner extraction processes (default one per core)')
+    arg_parse.add_argument('--step', type=int, default=5, help='use every STEP-th frame of a video')
+    arg_parse.add_argument('--per-bin', type=int, default=3, help='views to keep per image region and pose bin')
+    add_viewer_arguments(arg_parse)
+    args = arg_parse.parse_args()
+    main(args.video, args.images, args.output, args.workers, args.step, args.per_bin, args.headless,
+         make_viewer(args))
@@ -1,6 +1,15 @@
 # Calibration results
+#
+# The values below are the defaults. If there is an intrinsics file written by calibrate.py at INTRINSICS_PATH,
+# its values are used instead.
+import json
+import os
+import time
 import numpy as np
 
+INTRINSICS_VERSION = 1  # Format of the intrinsics files written by save_intrinsics
+INTRINSICS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'intrinsics.json')
+
 camera_matrix = np.array([[921.66598263, 0, 494.41949067],
  [  0, 921.66598263, 372.63597123],
  [  0, 0, 1]])
@@ -20,3 +29,28 @@ dist_coeff = np.array([[-7.40487443e+00],
  [ 0.00000000e+00],
  [ 0.00000000e+00],
  [ 0.00000000e+00]])
+
+
+def save_intrinsics(path, camera_matrix, dist_coeff, image_size, **info):
+    """Write a camera matrix and distortion coefficients to a JSON intrinsics file, with the image size they are
+    for and any other `info`, such as the RMS error of the calibration."""
+    intrinsics = dict(info, version=INTRINSICS_VERSION, created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      image_size=list(image_size), camera_matrix=np.asarray(camera_matrix).tolist(),
+                      dist_coeff=np.asarray(dist_coeff).ravel().tolist())
+    with open(path, 'w') as f:
+        json.dump(intrinsics, f, indent=2)
+
+
+def load_intrinsics(path):
+    """Read an intrinsics file. Returns (camera_matrix, dist_coeff, the whole file as a dict)."""
+    with open(path) as f:
+        intrinsics = json.load(f)
+    if intrinsics.get('version', 0) > INTRINSICS_VERSION:
+        raise ValueError('%s is intrinsics version %s, newer than this code reads (%d)' %
+                         (path, intrinsics.get('version'), INTRINSICS_VERSION))
+    return (np.array(intrinsics['camera_matrix'], dtype=float),
+            np.array(intrinsics['dist_coeff'], dtype=float).reshape(-1, 1), intrinsics)
+
+
+if os.path.exists(INTRINSICS_PATH):
+    camera_matrix, dist_coeff, _ = load_intrinsics(INTRINSICS_PATH)
@@ -0,0 +1,71 @@
+"""
+Pass flight commands to the drone.
+
+Keyboard and autopilot set the stick position of each axis on a `Commander`, which merges them in to one stick state
+and passes only the axes that changed on to the drone. tellopy's setters only store the stick values, and tellopy
+sends them from its own timer, so a change is passed on as soon as it is set rather than waiting for a send of ours.
+Take off, land and emergency are not sticks, and are sent straight away.
+If given a `recorder.Recorder`, the stick values passed on are recorded, e.g. to identify how the drone responds to them.
+
+Stick values are speeds from -100 to 100, as for tellopy's up/down etc. Positive is right (roll), forward (pitch),
+up (throttle) and clockwise (yaw).
+"""
+
+import threading
+import time
+from metrics import span
+
+AXES = ('roll', 'pitch', 'throttle', 'yaw')
+
+
+class Commander:
+    """Merge stick commands and pass the ones that changed to the drone."""
+    def __init__(self, drone, metrics=None, recorder=None):
+        self.drone = drone
+        self.metrics = metrics
+        self.recorder = recorder
+        self.sent = 0  # Axis updates passed to the drone
+        self.skipped = 0  # Axis updates not passed on because the value had not changed
+        self._stick = dict.fromkeys(AXES, 0.0)
+        self._last_sent = dict.fromkeys(AXES)
+        self._lock = threading.Lock()  # The keyboard and the autopilot set sticks from different threads
+        self._setters = {'roll': drone.set_roll, 'pitch': drone.set_pitch, 'throttle': drone.set_throttle, 'yaw': drone.set_yaw}
+
+    def set(self, capture=None, **axes):
+        """Set the stick position of some axes, e.g. `set(throttle=20, yaw=-5)`. Axes given as None are left as they are.
+        `capture` is the capture time of the frame the values were computed from, to measure camera-to-command latency.
+        It is only recorded if a stick changed, as otherwise no command was sent. Returns the sticks changed."""
+        with self._lock, span(self.metrics, 'send'):
+            changed = {}
+            for axis, value in axes.items():
+                if value is None:
+                    continue
+                self._stick[axis] = max(-100.0, min(100.0, float(value)))
+                if self._stick[axis] == self._last_sent[axis]:
+                    self.skipped += 1
+                    continue
+                self._setters[axis](self._stick[axis] / 100)
+                self._last_sent[axis] = changed[axis] = self._stick[axis]
+                self.sent += 1
+            if changed and self.recorder:
+                self.recorder.command(changed)
+        if changed and capture is not None and self.metrics:
+            self.metrics.record('camera_to_command', time.time() - capture)
+        return changed
+
+    def hover(self):
+        """Centre all sticks."""
+        self.set(**dict.fromkeys(AXES, 0))
+
+    def takeoff(self):
+        self.drone.takeoff()
+
+    def land(self):
+        """Centre the sticks and land."""
+        self.hover()
+        self.drone.land()
+
+    def emergency(self):
+        """Stop the motors immediately."""
+        self.drone.emergency()
+        self.hover()
@@ -0,0 +1,174 @@
+"""
+Run detectors on a pool of processes, to use more than one core.
+
+`DetectionEngine.submit` copies each frame in to a ring of frame buffers in shared memory, and sends only the slot
+number to the workers, so frames are never pickled. Every detector runs on the frame as a separate job, so the
+detectors for one frame run in parallel, and successive frames are pipelined across the pool. At most
+`max_in_flight` frames are in progress at once: submitting another waits for the oldest to finish, which keeps the
+latency bounded and means a ring slot is never overwritten while it is still being read.
+
+Results come back from `result` in the order the frames were submitted, with the sequence number of their frame:
+
+    engine = DetectionEngine({'markers': ('aruco', {}), 'ball': ('colour', {'lower': BLUE_LOWER, 'upper': BLUE_UPPER})})
+    with engine:
+        sequence = engine.submit(image)
+        sequence, results = engine.result()  # results['markers'] is a MarkerSet, results['ball'] an (x, y) offset
+
+Each worker process builds its own detectors, and any job can go to any worker, so detectors should not rely on
+seeing consecutive frames. The aruco detector here is the `aruco.Tracker` in pyramid mode, without the incremental
+and flow modes, which follow markers from one frame to the next.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+import cv2.cv2 as cv2
+import numpy as np
+import aruco
+import tracker
+
+MAX_HEIGHT, MAX_WIDTH = 720, 960
+
+
+class ArucoDetector:
+    """Aruco markers in a BGR frame, as an `aruco.MarkerSet` with poses."""
+    def __init__(self, **options):
+        self.tracker = aruco.Tracker(**dict({'pyramid': True}, **options))
+
+    def __call__(self, image):
+        self.tracker.update(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+        return self.tracker.marker_set
+
+
+class ColourDetector:
+    """(x, y) offset from the centre of the frame of the largest blob of a colour, as `tracker.Tracker.track`."""
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+        self.tracker = None
+
+    def __call__(self, image):
+        if self.tracker is None:
+            self.tracker = tracker.Tracker(image.shape[0], image.shape[1], self.lower, self.upper)
+        return self.tracker.track(image.copy())  # track draws on the frame, and other detectors share it
+
+
+# Detector kinds by name. Add new detectors here: a class made from keyword options, called with a BGR frame.
+DETECTORS = {
+    'aruco': ArucoDetector,
+    'colour': ColourDetector,
+}
+
+
+class FrameRing:
+    """`slots` BGR frame buffers in shared memory."""
+    def __init__(self, slots, height=MAX_HEIGHT, width=MAX_WIDTH, name=None):
+        self.owner = name is None
+        self.shape = (slots, height, width, 3)
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=int(np.prod(self.shape)))
+        self.frames = np.ndarray(self.shape, np.uint8, self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, slot, image):
+        """Copy a BGR image in to `slot`. Returns its (height, width)."""
+        height, width = image.shape[:2]
+        if height > self.shape[1] or width > self.shape[2]:
+            raise ValueError('Frame %dx%d is larger than the ring (%dx%d)' % (width, height, self.shape[2], self.shape[1]))
+        self.frames[slot, :height, :width] = image
+        return height, width
+
+    def view(self, slot, height, width):
+        """The image in `slot`, without copying."""
+        return self.frames[slot, :height, :width]
+
+    def close(self):
+        del self.frames  # Drop the view first, or the memory cannot be closed
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+# The worker process's ring and detectors, set up by _start_worker
+_ring = None
+_detectors = None
+
+
+def _start_worker(ring_name, ring_shape, detectors):
+    global _ring, _detectors
+    slots, height, width, _ = ring_shape
+    _ring = FrameRing(slots, height, width, name=ring_name)
+    _detectors = {name: DETECTORS[kind](**options) for name, (kind, options) in detectors.items()}
+
+
+def _detect(name, slot, height, width):
+    """Run detector `name` on the frame in `slot`."""
+    return _detectors[name](_ring.view(slot, height, width))
+
+
+class DetectionEngine:
+    """Detect in frames on a process pool, with at most `max_in_flight` frames in progress.
+    `detectors` is a dict of name: (kind, options), where kind is a key of DETECTORS.
+    `workers` defaults to one per core."""
+    def __init__(self, detectors, workers=None, max_in_flight=2, height=MAX_HEIGHT, width=MAX_WIDTH):
+        self.detectors = detectors
+        self.workers = workers or os.cpu_count()
+        self.max_in_flight = max_in_flight
+        self.submitted = 0
+        self._ring = FrameRing(max_in_flight, height, width)
+        self._pool = None
+        self._pending = deque()  # (sequence, {name: future}) of each frame not yet returned by `result`
+
+    def start(self):
+        """Start the worker processes. Returns self so it can be chained."""
+        self._pool = ProcessPoolExecutor(self.workers, initializer=_start_worker,
+                                         initargs=(self._ring.name, self._ring.shape, self.detectors))
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def in_flight(self):
+        """Frames submitted and not yet returned by `result`."""
+        return len(self._pending)
+
+    def submit(self, image):
+        """Start detecting in a BGR image, and return its sequence number.
+        If `max_in_flight` frames are already in progress, waits for the oldest to finish first. Its result stays
+        queued for `result`, but it no longer needs its ring slot."""
+        sequence = self.submitted
+        slot = sequence % self.max_in_flight
+        if len(self._pending) >= self.max_in_flight:
+            wait(self._pending[-self.max_in_flight][1].values())  # The frame using this slot
+        height, width = self._ring.write(slot, image)
+        futures = {name: self._pool.submit(_detect, name, slot, height, width) for name in self.detectors}
+        self._pending.append((sequence, futures))
+        self.submitted += 1
+        return sequence
+
+    def ready(self):
+        """True if the oldest frame's results are ready."""
+        return bool(self._pending) and all(future.done() for future in self._pending[0][1].values())
+
+    def result(self, timeout=None):
+        """Return (sequence, {name: result}) for the oldest frame, waiting up to `timeout` seconds for it.
+        Raises IndexError if no frame is in progress, and TimeoutError if it is not done in time."""
+        sequence, futures = self._pending[0]
+        results = {name: future.result(timeout) for name, future in futures.items()}
+        self._pending.popleft()
+        return sequence, results
+
+    def close(self):
+        """Stop the workers and free the ring."""
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        self._pending.clear()
+        self._ring.close()
@@ -0,0 +1,137 @@
+"""
+Estimate the error between the drone and the target, between and through video frames.
+
+The errors are the ones from `aruco.Tracker.calc_error`: x and y offset of the target from the reticle (mm), and the
+angle (yaw) of the target (degrees). Each is tracked by a small Kalman filter with state [error, rate of change]:
+- Telemetry (MVO velocity and IMU attitude) arrives faster than video, and measures the rate of change.
+- The marker pose, when a frame has the target in it, measures the error itself.
+So the errors can be read at any time, at whatever rate the control loop runs, and coast through short dropouts.
+
+Assumed telemetry axes, which have not been checked against a flight (`simulator` publishes the same ones, so it
+cannot check them either). A wrong sign makes telemetry pull the estimate away from the marker, which shows up as a
+rate that fights each correction:
+- MVO velocity is in m/s, vel_y is Left+ and vel_z is Down+
+- IMU yaw from the quaternion increases clockwise (seen from above)
+"""
+
+import threading
+import time
+from math import atan2, asin, pi, radians
+import numpy as np
+
+
+def quat2euler(w, x, y, z):
+    """
+    This is a modified version of this:
+    https://en.wikipedia.org/wiki/Conversion_between_quaternions_and_Euler_angles
+    """
+    ysqr = y * y
+
+    t0 = +2.0 * (w * x + y * z)
+    t1 = +1.0 - 2.0 * (x * x + ysqr)
+    X = atan2(t0, t1)
+
+    t2 = +2.0 * (w * y - z * x)
+    t2 = +1.0 if t2 > +1.0 else t2
+    t2 = -1.0 if t2 < -1.0 else t2
+    Y = asin(t2)
+
+    t3 = +2.0 * (w * z + x * y)
+    t4 = +1.0 - 2.0 * (ysqr + z * z)
+    Z = atan2(t3, t4)
+
+    X *= 180/pi
+    Y *= 180/pi
+    Z *= 180/pi
+
+    return (X, Y, Z,)
+
+
+def quat2euler_array(w, x, y, z):
+    """`quat2euler` of arrays of quaternions at once. Returns arrays of (X, Y, Z) in degrees."""
+    w, x, y, z = (np.asarray(v, dtype=float) for v in (w, x, y, z))
+    ysqr = y * y
+    X = np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + ysqr))
+    Y = np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0))
+    Z = np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (ysqr + z * z))
+    return np.degrees(X), np.degrees(Y), np.degrees(Z)
+
+
+class Estimator:
+    """Kalman filter of the x, y and angle errors to the target, and their rates of change."""
+    def __init__(self, marker_noise=(20, 20, 3), rate_noise=(100, 100, 10), process_noise=(500, 500, 50), max_age=1.0):
+        self.marker_var = np.square(marker_noise, dtype=float)  # Variance of the errors measured from the marker pose
+        self.rate_var = np.square(rate_noise, dtype=float)  # Variance of the rates measured from telemetry
+        self.process_var = np.square(process_noise, dtype=float)  # Variance of the rate of change of the rates
+        self.max_age = max_age  # Seconds without seeing the marker before the errors are no longer trusted
+        self.state = np.zeros((3, 2))  # [error, rate] per axis
+        self.covariance = np.tile(np.diag([1e6, 1e6]), (3, 1, 1))
+        self.distance = None  # Last distance to the target (mm)
+        self.last_seen = None  # Time the marker was last measured
+        self.clock = time.time  # Time source when no time is given, e.g. a recording's clock when replaying
+        self._time = None
+        self._yaw = None
+        self._yaw_time = None
+        self._lock = threading.Lock()  # Telemetry arrives on the tellopy thread
+
+    def _predict(self, now):
+        """Advance the state to time `now`, assuming constant rates."""
+        if self._time is None:
+            self._time = now
+        dt = now - self._time
+        if dt <= 0:
+            return
+        self._time = now
+        self.state[:, 0] += self.state[:, 1] * dt
+        p = self.covariance
+        p[:, 0, 0] += dt * (p[:, 1, 0] + p[:, 0, 1]) + dt * dt * p[:, 1, 1]
+        p[:, 0, 1] += dt * p[:, 1, 1]
+        p[:, 1, 0] += dt * p[:, 1, 1]
+        p += self.process_var[:, None, None] * np.array([[dt**4 / 4, dt**3 / 2], [dt**3 / 2, dt**2]])
+
+    def _measure(self, index, values, variance):
+        """Kalman update of state `index` (0 error, 1 rate) of every axis, with measured `values`."""
+        p = self.covariance
+        gain = p[:, :, index] / (p[:, index, index] + variance)[:, None]
+        self.state += gain * (values - self.state[:, index])[:, None]
+        self.covariance = p - gain[:, :, None] * p[:, index, None, :]
+
+    def update_telemetry(self, log_data, now=None):
+        """Measure the rates of change of the errors from a log data row, of `telemetry.LOG_DTYPE`."""
+        now = self.clock() if now is None else now
+        yaw = quat2euler(float(log_data['q0']), float(log_data['q1']), float(log_data['q2']), float(log_data['q3']))[2]
+        with self._lock:
+            previous_yaw, previous_time = self._yaw, self._yaw_time
+            self._yaw, self._yaw_time = yaw, now
+            self._predict(now)
+            if previous_yaw is None or now <= previous_time:
+                return
+            yaw_rate = ((yaw - previous_yaw + 180) % 360 - 180) / (now - previous_time)  # degrees/s, clockwise+
+            right, up = -float(log_data['vel_y']) * 1000, -float(log_data['vel_z']) * 1000  # mm/s
+            distance = self.distance or 0
+            # Moving or turning right moves the target left of the reticle, climbing moves it down
+            rates = np.array([-right - radians(yaw_rate) * distance, -up, yaw_rate])
+            self._measure(1, rates, self.rate_var)
+
+    def correct(self, errors, distance, now=None):
+        """Measure the errors from the marker pose, as returned by `Tracker.calc_error`."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            self._predict(now)
+            if self.last_seen is None or now - self.last_seen > self.max_age:
+                self.state[:, 0] = errors  # Start afresh after losing the target
+                self.covariance[:, 0, 0] = self.marker_var
+                self.covariance[:, 0, 1] = self.covariance[:, 1, 0] = 0
+            else:
+                self._measure(0, np.asarray(errors, dtype=float), self.marker_var)
+            self.distance = distance
+            self.last_seen = now
+
+    def errors(self, now=None):
+        """The estimated (x, y, angle) errors at time `now`. All zero if the target has not been seen recently."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            if self.last_seen is None or now - self.last_seen > self.max_age:
+                return 0, 0, 0
+            self._predict(now)
+            return tuple(self.state[:, 0].tolist())
@@ -17,15 +17,29 @@ MVO axes:
 
 """
 
+import argparse
+import asyncio
 import sys
+import time
 import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import tellopy
-import av
 import cv2.cv2 as cv2  # for avoidance of pylint error
-import numpy as np
-import time
+import hud
 from aruco import Tracker
+from commander import Commander
+from estimator import Estimator
+from markermap import Localizer, MarkerMap
+from metrics import Metrics
+from recorder import Recorder, ReplayDrone
+from runtime import Channel, Runtime, ticks
 from simple_pid import PID
+from simulator import SimulatedTello
+from telemetry import Telemetry
+from undistort import UndistortMap
+from video import Frame, FrameGrabber, open_video
+from viewer import add_viewer_arguments, make_viewer
 
 SPEED = 20
 MAX_SPEED = 40
@@ -33,42 +47,62 @@ CAMERA_HEIGHT, CAMERA_WIDTH = 720, 960
 CAMERA_VFOV = 43
 CAMERA_HFOV = 60
 CAMERA_HORIZON = 185
+CONTROL_PERIOD = 1/60  # Seconds between control updates, whether or not there is a new video frame
+DISPLAY_PERIOD = 1/60  # Seconds between keyboard polls
+TARGET_ID = 2
+# (Kp, Ki, Kd) of each controller, and how often it updates. python tune.py searches for better ones offline
+# The errors are those of `aruco.Tracker.calc_error`: 'z' and 'yaw' act on the marker offset in mm, and 'y' (roll)
+# on the marker yaw in degrees. The 'y' gains were tuned on the old angle, 10 x the difference in pixels of the
+# marker's edge heights, which is about 1.6 x the yaw in degrees with the marker 1 m away, so they are 1.6 x those.
+PID_GAINS = {
+    'y': (-0.13, -0.011, -0.005),
+    'z': (-0.15, -0.01, -0.005),
+    'yaw': (-0.08, -0.007, -0.003),
+}
+PID_SAMPLE_TIME = 1/60
 
-flight_data = None
-log_data = None
 
 def draw_text(image, text, row):
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.5
-    font_size = 24
-    font_color = (255,255,255)
-    left_mergin = 10
-    if row < 0:
-        pos =  (left_mergin, CAMERA_HEIGHT + font_size * row + 1)
-    else:
-        pos =  (left_mergin, font_size * (row + 1))
-    cv2.putText(image, text, pos, font, font_scale, font_color, 1, cv2.LINE_AA)
+    pos = hud.text_origin(row, CAMERA_HEIGHT)
+    cv2.putText(image, text, pos, hud.FONT, hud.FONT_SCALE, hud.TEXT_COLOUR, 1, cv2.LINE_AA)
+
 
+def hud_rows(autopilot_on, flight_data=None, log_data=None):
+    """The lines of text on the HUD, as a dict of row: text."""
+    rows = telemetry_rows(flight_data, log_data)
+    rows[1] = 'Autopilot: ' + str(autopilot_on)
+    return rows
 
-def draw_hud(image, autopilot_on):
-    """Draw heads up display (HUD) on the image."""
+
+def telemetry_rows(flight_data=None, log_data=None):
+    """The HUD lines of a flight data and a log data row, of `telemetry.FLIGHT_DTYPE` and `telemetry.LOG_DTYPE`."""
+    rows = {}
+    # Flight dynamics
+    if flight_data is not None:
+        rows[0] = 'ALT: %2d | SPD: %2d | BAT: %2d | WIFI: %2d | CAM: %2d | MODE: %2d' % (
+            flight_data['height'], flight_data['ground_speed'], flight_data['battery_percentage'],
+            flight_data['wifi_strength'], flight_data['camera_state'], flight_data['fly_mode'])
+    if log_data is not None:
+        rows[-3] = 'MVO: VEL: %5.2f %5.2f %5.2f POS: %5.2f %5.2f %5.2f' % tuple(
+            log_data[name] for name in ('vel_x', 'vel_y', 'vel_z', 'pos_x', 'pos_y', 'pos_z'))
+        rows[-2] = 'IMU: ACC: %5.2f %5.2f %5.2f GYRO: %5.2f %5.2f %5.2f' % tuple(
+            log_data[name] for name in ('acc_x', 'acc_y', 'acc_z', 'gyro_x', 'gyro_y', 'gyro_z'))
+        rows[-1] = '     QUATERNION: %5.2f %5.2f %5.2f %5.2f VG: %5.2f %5.2f %5.2f' % tuple(
+            log_data[name] for name in ('q0', 'q1', 'q2', 'q3', 'vg_x', 'vg_y', 'vg_z'))
+    return rows
+
+
+def draw_hud(image, autopilot_on, flight_data=None, log_data=None):
+    """Draw heads up display (HUD) on the image, with the latest telemetry.
+    Draws everything afresh. `hud.Hud` composites the same HUD from cached layers."""
     # Draw horizontal and vertical line in middle of frame
     #color = (191, 201, 202)
     #x, y = int(CAMERA_WIDTH/2), int(CAMERA_HEIGHT/2)
     #cv2.line(image, (0, y), (CAMERA_WIDTH, y), color, 1, cv2.LINE_AA)
     #cv2.line(image, (x, 0), (x, CAMERA_HEIGHT), color, 1, cv2.LINE_AA)
     image = draw_horizon(image)
-
-    # Flight dynamics
-    if flight_data:
-        draw_text(image, str(flight_data), 0)
-    if log_data:
-        draw_text(image, 'MVO: ' + str(log_data.mvo), -3)
-        draw_text(image, ('IMU: ' + str(log_data.imu))[0:52], -2)
-        draw_text(image, '     ' + ('IMU: ' + str(log_data.imu))[52:], -1)
-
-    draw_text(image, 'Autopilot: ' + str(autopilot_on), 1)
-
+    for row, text in hud_rows(autopilot_on, flight_data, log_data).items():
+        draw_text(image, text, row)
     return image
 
 
@@ -104,220 +138,345 @@ def calc_gluideslope(angle):
     return (x, y)
 
 
-def flight_data_handler(event, sender, data, **args):
-    global flight_data, log_data
-    drone = sender
-    if event is drone.EVENT_FLIGHT_DATA:
-        flight_data = str(data)
-    elif event is drone.EVENT_LOG_DATA:
-        log_data = data
-
-
-def fly_with_keyboard(drone, key):
+def fly_with_keyboard(commander, key):
     """Command the drone from the keyboard."""
     if key == ord('t'):
-        drone.takeoff()
-    elif key == ord('l') or key == 32:
-        # TODO space (key 32) should be emergency stop
-        drone.land()
+        commander.takeoff()
+    elif key == ord('l'):
+        commander.land()
+    elif key == 32:
+        # Space stops the motors, wherever the drone is
+        commander.emergency()
     elif key == ord('s'):
-        drone.backward(SPEED)
+        commander.set(pitch=-SPEED)
     elif key == ord('w'):
-        drone.forward(SPEED/2)
+        commander.set(pitch=SPEED/2)
     elif key == ord('a'):
-        drone.left(SPEED)
+        commander.set(roll=-SPEED)
     elif key == ord('d'):
-        drone.right(SPEED)
+        commander.set(roll=SPEED)
     elif key == ord('q'):
-        drone.counter_clockwise(SPEED)
+        commander.set(yaw=-SPEED)
     elif key == ord('e'):
-        drone.clockwise(SPEED)
+        commander.set(yaw=SPEED)
     elif key == ord('c'):
-        drone.up(SPEED)
+        commander.set(throttle=SPEED)
     elif key == ord('z'):
-        drone.down(SPEED)
+        commander.set(throttle=-SPEED)
     elif key == ord('x'):
         # Make drone hover
-        drone.left(0)
-        drone.right(0)
-        drone.up(0)
-        drone.down(0)
-        drone.counter_clockwise(0)
-        drone.clockwise(0)
-        drone.forward(0)
-        drone.backward(0)
+        commander.hover()
     elif key != 255:
         print('Unknown key pressed:', key)
 
 
-def quat2euler(w, x, y, z):
-    """
-    This is a modified version of this:
-    https://en.wikipedia.org/wiki/Conversion_between_quaternions_and_Euler_angles
-    """
-    from math import atan2, pi, asin
-    ysqr = y * y
-
-    t0 = +2.0 * (w * x + y * z)
-    t1 = +1.0 - 2.0 * (x * x + ysqr)
-    X = atan2(t0, t1)
-
-    t2 = +2.0 * (w * y - z * x)
-    t2 = +1.0 if t2 > +1.0 else t2
-    t2 = -1.0 if t2 < -1.0 else t2
-    Y = asin(t2)
-
-    t3 = +2.0 * (w * z + x * y)
-    t4 = +1.0 - 2.0 * (ysqr + z * z)
-    Z = atan2(t3, t4)
-
-    X *= 180/pi
-    Y *= 180/pi
-    Z *= 180/pi
-
-    return (X, Y, Z,)
-
-
-
-def main():
-    drone = tellopy.Tello()
-    tracker = Tracker()
-    control_y = PID(-0.08, -0.007, -0.003, setpoint=0)
-    control_z = PID(-0.15, -0.01, -0.005, setpoint=0)
-    control_yaw = PID(-0.08, -0.007, -0.003, setpoint=0)
-    control_y.sample_time = 1/60
-    control_z.sample_time = 1/60
-    control_yaw.sample_time = 1/60
-    control_y.output_limits = (-MAX_SPEED, MAX_SPEED)
-    control_z.output_limits = (-MAX_SPEED, MAX_SPEED)
-    control_yaw.output_limits = (-MAX_SPEED, MAX_SPEED)
-    reticle = calc_gluideslope(-5)
-
-    try:
-        drone.subscribe(drone.EVENT_FLIGHT_DATA, flight_data_handler)
-        drone.subscribe(drone.EVENT_LOG_DATA, flight_data_handler)
-
-        drone.connect()
-        drone.wait_for_connection(60.0)
-
-        retry = 3
-        container = None
-        while container is None and 0 < retry:
-            retry -= 1
-            try:
-                container = av.open(drone.get_video_stream())
-            except av.AVError as ave:
-                print(ave)
-                print('retry...')
-
-        # Start without the autopilot
-        autopilot_on = False
-        control_y.auto_mode = False
-        control_z.auto_mode = False
-        control_yaw.auto_mode = False
-
-        frame_skip = 300  # Skip first frames
+Detection = namedtuple('Detection', 'frame markers target_capture pose')
+
+
+class Flight:
+    """The stages of a flight, run as tasks by a `runtime.Runtime`:
+    - ingest: hands decoded frames from the `FrameGrabber` to the frames channel
+    - detect: finds the markers in each new frame on the vision executor, and corrects the estimator
+    - control: updates the PIDs from the estimator every CONTROL_PERIOD, and sets the sticks
+    - display: polls the keyboard, and draws the HUD on the render executor for each new detection
+    If `headless` there is no window: frames are only drawn if there is a `viewer.Viewer` to hand them to, and keys
+    only come from the viewer's preview window.
+    If given `localizer`, a `markermap.Localizer`, the pose of the drone in the room is found from each detection and
+    shown on the HUD.
+    The time from `started`, a `time.perf_counter` time, to the first control update made with a detection is
+    recorded as 'time_to_first_control'.
+    Telemetry events are parsed in to rows of `telemetry`, a `telemetry.Telemetry` store (a new one timed by `clock`
+    if not given), log data rows are fed to the estimator as they arrive, and the newest rows published on the
+    flight_data and log_data channels. The HUD lines are only formatted again when there is a new row.
+    When replaying, `sync` is called with the record time of each frame before it is processed, see
+    `recorder.ReplayDrone.advance`, and the estimator is corrected at that time.
+    Stages share data through the frames, detections, flight_data and log_data channels."""
+    def __init__(self, tracker, estimator, commander, metrics, clock=time.time, lossless=False, headless=False,
+                 viewer=None, localizer=None, started=None, telemetry=None, sync=None):
+        self.grabber = None
+        self.sync = sync
+        self.store = telemetry or Telemetry(clock=clock)  # The telemetry rows
+        self.started = time.perf_counter() if started is None else started
+        self.headless = headless
+        self.viewer = viewer
+        self.tracker = tracker
+        self.localizer = localizer
+        self.estimator = estimator
+        self.commander = commander
+        self.metrics = metrics
+        self.lossless = lossless  # Process every frame, and control once per frame, so a replay is repeatable
+        self.runtime = Runtime()
+        self.frames: Channel[Frame] = self.runtime.channel('frames')
+        self.detections: Channel[Detection] = self.runtime.channel('detections')
+        self.flight_data = self.runtime.channel('flight_data')
+        self.log_data = self.runtime.channel('log_data')
+        self._telemetry_rows = (None, {})  # The channel versions the HUD lines were formatted for, and the lines
+        self.reticle = calc_gluideslope(-5)
+        self.hud = hud.Hud(lambda image: draw_reticle(draw_horizon(image), self.reticle), CAMERA_WIDTH, CAMERA_HEIGHT)
+        self.autopilot_on = False
+        self.show_metrics = False
+        self.frame_age = 0.0  # Seconds from decode to control of the frame the last control update used
+        self.control_y = PID(*PID_GAINS['y'], setpoint=0, time_fn=clock)
+        self.control_z = PID(*PID_GAINS['z'], setpoint=0, time_fn=clock)
+        self.control_yaw = PID(*PID_GAINS['yaw'], setpoint=0, time_fn=clock)
+        for control in (self.control_y, self.control_z, self.control_yaw):
+            control.sample_time = PID_SAMPLE_TIME
+            control.output_limits = (-MAX_SPEED, MAX_SPEED)
+            control.auto_mode = False  # Start without the autopilot
+
+    def flight_data_handler(self, event, sender, data, **args):
+        """Store tellopy's telemetry events, which arrive on its own thread, measure the rates of change of the errors
+        from each log data row, and publish the rows."""
+        drone = sender
+        row = self.store.add(event, sender, data)
+        if event is drone.EVENT_FLIGHT_DATA:
+            self.flight_data.publish_threadsafe(row)
+        elif event is drone.EVENT_LOG_DATA:
+            # The estimator takes it at once, so when replaying it has every row up to a frame before the frame
+            self.estimator.update_telemetry(row, float(row['time']))
+            self.log_data.publish_threadsafe(row)
+
+    async def run(self, grabber):
+        """Fly on the frames decoded by `grabber`, until the video ends."""
+        self.grabber = grabber.start()
+        await self.runtime.run(self.ingest(), self.detect(), self.control(), self.display())
+
+    async def ingest(self):
+        """Publish each decoded frame, until the stream ends."""
+        detected = 0
+        while self.grabber.running:
+            frame = await self.runtime.run_in('ingest', self.grabber.read, 0.1)
+            if frame is None:
+                continue
+            if self.sync and frame.record_time is not None:
+                self.sync(frame.record_time)
+            self.frames.publish(frame)
+            if self.lossless:
+                _, detected = await self.detections.next(detected)
+
+    async def detect(self):
+        """Detect markers in the newest frame, skipping any frames that arrived while busy."""
+        version = 0
         while True:
-            for frame in container.decode(video=0):
-                # If transforms are taking too long then start skipping frames
-                if frame_skip > 0:
-                    frame_skip -= 1
-                    continue
-                start_time = time.time()
-                image = cv2.cvtColor(np.array(frame.to_image()), cv2.COLOR_RGB2BGR)
-
-                # Key presses give the drone a speed, and not a distance to move. Press x to stop all movement
-                key = cv2.waitKey(1) & 0xFF
-                fly_with_keyboard(drone, key)
-
-                # Toggle autopilot
-                if key == ord('p'):
-                    autopilot_on = not autopilot_on
-                    if autopilot_on:
-                        #control_y.auto_mode = True
-                        control_z.auto_mode = True
-                        control_yaw.auto_mode = True
-                    else:
-                        #control_y.auto_mode = False
-                        control_z.auto_mode = False
-                        control_yaw.auto_mode = False
-
-                tracker.update(image)
-                image = tracker.draw_markers(image)
-                image = draw_reticle(image, reticle)
-                error_yaw, error_z, error_y = tracker.calc_error(2, reticle)
-
-                #print('Errors:', error_yaw, error_z, error_y)
-
-                v_y = control_y(error_y)
-                v_z = control_z(error_z)
-                v_yaw = control_yaw(error_yaw)
-                #print('error y', error_y, 'v_y', v_y, 'PID', control_y.components)
-                #print('error z', error_z, 'v_z', v_z, 'PID', control_z.components)
-                #print('error yaw', error_y, 'v_yaw', v_yaw, 'PID', control_yaw.components)
-
-                #print(log_data.imu)
-                #print(type(log_data.imu))
-                imu = log_data.imu
-                #print(quat2euler(imu.q0, imu.q1, imu.q2, imu.q3))  # roll, pitch, yaw
-
-                tracker.draw_axes(image)
-
-                try:
-                    if tracker.distances[0] < 1000:
-                        control_y.auto_mode = True
-                    else:
-                        control_y.auto_mode = False
-                except KeyError:
-                    pass
-
-                if autopilot_on:
-                    if v_z is None:
-                        pass
-                    elif v_z > 0:
-                        drone.up(v_z)
-                    else:
-                        drone.down(abs(v_z))
-
-                    if v_y is None:
-                        pass
-                    elif v_y > 0:
-                        drone.right(v_y)
-                    else:
-                        drone.left(abs(v_y))
-
-                    if v_yaw is None:
-                        pass
-                    elif v_yaw > 0:
-                        drone.clockwise(v_yaw)
-                    else:
-                        drone.counter_clockwise(abs(v_yaw))
-
-
-                # Display an image with edge detection. Make smaller so can fit on screen with the HUD
-                #img = cv2.resize(image, (300, 225))
-                #cv2.imshow('Canny', cv2.Canny(img, 100, 200))
-
-                # Display full image with HUD
-                image = draw_hud(image, autopilot_on)
-                cv2.imshow('Drone', image)
-
-                # Determine if need to skip any frames
-                if frame.time_base < 1.0/60:
-                    time_base = 1.0/60
-                else:
-                    time_base = frame.time_base
-                frame_skip = int((time.time() - start_time)/time_base)
-
+            frame, version = await self.frames.next(version)
+            self.detections.publish(await self.runtime.run_in('vision', self._detect, frame))
+
+    def _detect(self, frame):
+        """Find the markers in `frame`, correct the estimated errors if the target is in it, and locate the drone."""
+        with self.metrics.span('convert'):
+            gray = frame.gray
+        self.tracker.update(gray)
+        markers = self.tracker.marker_set
+        target_capture = None
+        if TARGET_ID in markers:
+            error = self.tracker.calc_error(TARGET_ID, self.reticle)
+            self.estimator.correct(error, markers.distances[markers.row(TARGET_ID)], frame.record_time)
+            target_capture = self.metrics.capture_time(frame)
+        pose = self.localizer.locate(markers) if self.localizer else None
+        return Detection(frame, markers, target_capture, pose)
+
+    async def control(self):
+        """Control from the estimate, which telemetry keeps current between frames.
+        Runs every CONTROL_PERIOD, or once per detection if lossless."""
+        target_capture = None  # Estimated capture time of the last frame the target was seen in
+        commanded = None  # The capture time that camera_to_command was last recorded for
+        first = True
+        async for _ in self._detected() if self.lossless else ticks(CONTROL_PERIOD):
+            detection = self.detections.value
+            if detection is not None:
+                if first:
+                    first = False
+                    self.metrics.record('time_to_first_control', time.perf_counter() - self.started)
+                target_capture = detection.target_capture or target_capture
+                self.frame_age = time.time() - detection.frame.decode_time
+                markers = detection.markers
+                if 0 in markers:
+                    self.control_y.auto_mode = markers.distances[markers.row(0)] < 1000
+
+            with self.metrics.span('control'):
+                error_yaw, error_z, error_y = self.estimator.errors()
+                v_y = self.control_y(error_y)
+                v_z = self.control_z(error_z)
+                v_yaw = self.control_yaw(error_yaw)
+            #print('error y', error_y, 'v_y', v_y, 'PID', self.control_y.components)
+            #print('error z', error_z, 'v_z', v_z, 'PID', self.control_z.components)
+            #print('error yaw', error_y, 'v_yaw', v_yaw, 'PID', self.control_yaw.components)
+
+            if self.autopilot_on:
+                with self.metrics.span('command'):
+                    # The estimator coasts on the last frame with the target, but its latency is only measured once
+                    capture = target_capture if target_capture != commanded else None
+                    if self.commander.set(throttle=v_z, roll=v_y, yaw=v_yaw, capture=capture) and capture is not None:
+                        commanded = capture
+
+    async def _detected(self):
+        """Yield once for each new detection."""
+        version = 0
+        while True:
+            _, version = await self.detections.next(version)
+            yield version
+
+    async def display(self):
+        """Poll the keyboard, and show each new detection with the HUD drawn on it."""
+        version = 0
+        async for _ in ticks(DISPLAY_PERIOD):
+            self.metrics.tick()
+
+            # Key presses give the drone a speed, and not a distance to move. Press x to stop all movement
+            if self.headless:
+                key = self.viewer.key() if self.viewer else 255
+            else:
+                with self.metrics.span('display'):
+                    key = cv2.waitKey(1) & 0xFF
+            fly_with_keyboard(self.commander, key)
+            if key == ord('m'):
+                self.show_metrics = not self.show_metrics
+            if key == ord('p'):
+                self.toggle_autopilot()
+
+            if self.detections.version == version or (self.headless and not self.viewer):
+                continue
+            detection, version = self.detections.value, self.detections.version
+            image = await self.runtime.run_in('render', self._render, detection)
+            with self.metrics.span('display'):
+                if self.viewer:
+                    self.viewer.show(image)
+                if not self.headless:
+                    cv2.imshow('Drone', image)
+
+    def toggle_autopilot(self):
+        self.autopilot_on = not self.autopilot_on
+        #self.control_y.auto_mode = self.autopilot_on
+        self.control_z.auto_mode = self.autopilot_on
+        self.control_yaw.auto_mode = self.autopilot_on
+
+    def _render(self, detection):
+        """The frame of `detection` with the markers and HUD drawn on it."""
+        with self.metrics.span('convert'):
+            image = detection.frame.bgr
+        with self.metrics.span('hud'):
+            image = self.tracker.draw_markers(image, detection.markers)
+            self.tracker.draw_axes(image, detection.markers)
+
+            # Display an image with edge detection. Make smaller so can fit on screen with the HUD
+            #img = cv2.resize(image, (300, 225))
+            #cv2.imshow('Canny', cv2.Canny(img, 100, 200))
+
+            # Horizon, reticle and text are composited from cached layers
+            versions = self.flight_data.version, self.log_data.version
+            if versions != self._telemetry_rows[0]:
+                self._telemetry_rows = versions, telemetry_rows(self.flight_data.value, self.log_data.value)
+            rows = dict(self._telemetry_rows[1])
+            rows[1] = 'Autopilot: ' + str(self.autopilot_on)
+            grabber = self.grabber
+            rows[2] = 'Video: age %3d ms, dropped %d of %d, backlog %.1f %s' % (
+                self.frame_age * 1000, grabber.dropped, grabber.decoded, grabber.backlog, grabber.skip_frame.lower())
+            if self.show_metrics:
+                rows[3] = self.metrics.hud_text()
+            pose = detection.pose
+            if pose is not None:
+                x, y, z = pose.position
+                rows[4] = 'Room: x %5d y %5d z %5d mm, heading %4d, %d markers' % (x, y, z, pose.heading, pose.markers)
+            image = self.hud.draw(image, rows)
+        return image
+
+
+def main(drone=None, record=None, clock=time.time, lossless=False, metrics_path=None, headless=False, viewer=None,
+         map_path=None, telemetry_dir=None):
+    """Fly the drone, or a stand in for it such as a `ReplayDrone`.
+    If `record` is a path, the video, telemetry and stick commands are recorded to it. Control is timed by `clock`.
+    If `lossless` every video frame is processed, instead of only the newest.
+    Stage latencies are appended to `metrics_path` as JSON lines, if given. Press m to show them on the HUD.
+    If `headless` no window is opened. Annotated frames go to `viewer`, a `viewer.Viewer`, if given.
+    If `map_path` is a marker map file, the drone is located in the room from the markers on it.
+    If `telemetry_dir` is a directory, the telemetry rows are spilled to column files in it."""
+    started = time.perf_counter()
+    drone = drone or tellopy.Tello()
+    metrics = Metrics(metrics_path)
+    recorder = Recorder(record) if record else None
+    commander = Commander(drone, metrics=metrics, recorder=recorder)
+    telemetry = Telemetry(clock=clock, spill_dir=telemetry_dir)
+
+    def prepare():
+        """Build the flight, with the detector warmed up, while the drone connects."""
+        undistort = UndistortMap.load()
+        tracker = Tracker(incremental=True, pyramid=True, flow=True, metrics=metrics, undistort=undistort)
+        tracker.warm_up(CAMERA_WIDTH, CAMERA_HEIGHT)
+        localizer = Localizer(MarkerMap.load(map_path), undistort, metrics=metrics) if map_path else None
+        estimator = Estimator()
+        estimator.clock = clock
+        return Flight(tracker, estimator, commander, metrics, clock=clock, lossless=lossless, headless=headless,
+                      viewer=viewer, localizer=localizer, started=started, telemetry=telemetry,
+                      sync=getattr(drone, 'advance', None))
+
+    grabber = None
+    try:
+        with ThreadPoolExecutor(1, thread_name_prefix='Warmup') as executor:
+            if viewer:
+                viewer.start()  # Before the warm up thread starts, as the viewer process is forked
+            preparing = executor.submit(prepare)
+            if recorder:
+                drone.subscribe(drone.EVENT_FLIGHT_DATA, recorder.handler)
+                drone.subscribe(drone.EVENT_LOG_DATA, recorder.handler)
+
+            drone.connect()
+            drone.wait_for_connection(60.0)
+            flight = preparing.result()
+        # Only the recorder needs the telemetry from before the flight was ready
+        drone.subscribe(drone.EVENT_FLIGHT_DATA, flight.flight_data_handler)
+        drone.subscribe(drone.EVENT_LOG_DATA, flight.flight_data_handler)
+
+        stream = drone.get_video_stream()
+        container = open_video(recorder.stream(stream) if recorder else stream)
+
+        # Decode in the background, always working on the newest frame
+        grabber = FrameGrabber(container, lossless=lossless, metrics=metrics, low_latency=True,
+                               stamp=getattr(drone, 'stream_time', None))
+        asyncio.run(flight.run(grabber))
 
     except Exception as ex:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback)
         print(ex)
     finally:
+        if grabber:
+            grabber.stop()
         drone.quit()
-        cv2.destroyAllWindows()
+        if recorder:
+            recorder.close()
+        telemetry.close()
+        metrics.dump()
+        if viewer:
+            viewer.stop()
+        if not headless:
+            cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
-    main()
+    arg_parse = argparse.ArgumentParser()
+    arg_parse.add_argument('--record', help='record the video and telemetry to this file')
+    arg_parse.add_argument('--replay', help='fly a recording instead of the drone')
+    arg_parse.add_argument('--realtime', action='store_true', help='replay at the recorded pace, not as fast as possible')
+    arg_parse.add_argument('--metrics', help='append stage latencies to this JSON lines file')
+    arg_parse.add_argument('--map', help='marker map file, to locate the drone in the room')
+    arg_parse.add_argument('--telemetry', help='spill the telemetry to column files in this directory')
+    arg_parse.add_argument('--simulate', action='store_true', help='fly a simulated drone in the room of --map')
+    arg_parse.add_argument('--latency', type=float, default=0.0, help='simulated link delay (s)')
+    arg_parse.add_argument('--jitter', type=float, default=0.0, help='simulated random extra link delay, up to (s)')
+    arg_parse.add_argument('--loss', type=float, default=0.0, help='simulated packet loss, 0 to 1')
+    arg_parse.add_argument('--video-latency', type=float, default=0.0, help='simulated camera and encoder delay (s)')
+    add_viewer_arguments(arg_parse)
+    args = arg_parse.parse_args()
+    viewer = make_viewer(args)
+    if args.simulate:
+        simulated = SimulatedTello(MarkerMap.load(args.map) if args.map else None, latency=args.latency,
+                                   jitter=args.jitter, loss=args.loss, video_latency=args.video_latency)
+        main(simulated, record=args.record, metrics_path=args.metrics, headless=args.headless, viewer=viewer,
+             map_path=args.map, telemetry_dir=args.telemetry)
+    elif args.replay:
+        replay = ReplayDrone(args.replay, realtime=args.realtime)
+        main(replay, record=args.record, clock=replay.clock, lossless=not args.realtime, metrics_path=args.metrics,
+             headless=args.headless, viewer=viewer, map_path=args.map, telemetry_dir=args.telemetry)
+    else:
+        main(record=args.record, metrics_path=args.metrics, headless=args.headless, viewer=viewer, map_path=args.map,
+             telemetry_dir=args.telemetry)
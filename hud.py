@@ -0,0 +1,122 @@
+"""
+Composite the heads up display (HUD) on to video frames.
+
+Most of the HUD is the same from frame to frame: the horizon and reticle never move, and the telemetry text only
+changes a few times a second. So rather than drawing every line and string on each frame, `Hud` keeps the HUD as
+sprites of premultiplied colour and alpha, and only rasterises the ones whose inputs changed:
+- The static layer (anything drawn by `draw_static`) is rasterised once, and cut into a sprite per separate shape so
+  the empty space between them is never touched.
+- Each line of text is rasterised once per distinct string, and kept in a cache.
+Each sprite is blended on to the frame with one vectorized multiply-add over its own box.
+"""
+
+from functools import lru_cache
+import cv2.cv2 as cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+LINE_HEIGHT = 24
+LEFT_MARGIN = 10
+TEXT_COLOUR = (255, 255, 255)
+
+
+def text_origin(row, height):
+    """Bottom left of the text on `row`, counting from the top, or up from the bottom if negative."""
+    if row < 0:
+        return LEFT_MARGIN, height + LINE_HEIGHT * row + 1
+    return LEFT_MARGIN, LINE_HEIGHT * (row + 1)
+
+
+def rasterise(draw, shape):
+    """Run `draw(image)` on a blank image of `shape` (height, width), returning the premultiplied colour and
+    the alpha of what it drew, as uint8 images.
+    Drawn on black and on white, the difference between the two gives the coverage of anti-aliased edges."""
+    black = np.zeros(shape + (3,), np.uint8)
+    white = np.full(shape + (3,), 255, np.uint8)
+    draw(black)
+    draw(white)
+    alpha = 255 - cv2.absdiff(white, black).max(axis=2)
+    return black, alpha
+
+
+class Sprite:
+    """Premultiplied colour and inverse alpha (both BGR uint8) to blend on to a frame at (x, y)."""
+    __slots__ = ('x', 'y', 'colour', 'inverse')
+
+    def __init__(self, x, y, colour, alpha):
+        self.x = x
+        self.y = y
+        self.colour = np.ascontiguousarray(colour)
+        self.inverse = cv2.merge([255 - alpha] * 3)
+
+    def clipped(self, width, height):
+        """This sprite cut to fit a frame of `width` x `height`, or None if it is off the frame."""
+        x0, y0 = max(self.x, 0), max(self.y, 0)
+        x1 = min(self.x + self.colour.shape[1], width)
+        y1 = min(self.y + self.colour.shape[0], height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        if (x0, y0, x1 - x0, y1 - y0) == (self.x, self.y, self.colour.shape[1], self.colour.shape[0]):
+            return self
+        rows, columns = slice(y0 - self.y, y1 - self.y), slice(x0 - self.x, x1 - self.x)
+        return Sprite(x0, y0, self.colour[rows, columns], 255 - self.inverse[rows, columns, 0])
+
+    def blend(self, image):
+        """image = image * (1 - alpha) + colour, over the sprite's box."""
+        h, w = self.colour.shape[:2]
+        box = image[self.y:self.y + h, self.x:self.x + w]
+        cv2.multiply(box, self.inverse, dst=box, scale=1 / 255)
+        cv2.add(box, self.colour, dst=box)
+
+
+@lru_cache(maxsize=256)
+def text_sprite(text):
+    """(colour, alpha, ascent) of `text`, rasterised the same as `cv2.putText` would on a frame."""
+    (width, ascent), descent = cv2.getTextSize(text, FONT, FONT_SCALE, 1)
+    shape = (ascent + descent + 2, width + 2)
+    colour, alpha = rasterise(
+        lambda image: cv2.putText(image, text, (1, ascent + 1), FONT, FONT_SCALE, TEXT_COLOUR, 1, cv2.LINE_AA), shape)
+    return colour, alpha, ascent + 1
+
+
+def shape_sprites(colour, alpha):
+    """Cut a full frame layer into a sprite for each separate shape on it."""
+    count, _, stats, _ = cv2.connectedComponentsWithStats((alpha > 0).astype(np.uint8), connectivity=8)
+    sprites = []
+    for x, y, w, h, _ in stats[1:]:  # Label 0 is the background
+        sprites.append(Sprite(x, y, colour[y:y + h, x:x + w], alpha[y:y + h, x:x + w]))
+    return sprites
+
+
+class Hud:
+    """Static layer plus lines of text, blended on to frames of `height` x `width`."""
+    def __init__(self, draw_static, width, height):
+        self.width = width
+        self.height = height
+        self._static = shape_sprites(*rasterise(draw_static, (height, width)))
+        self._rows = {}  # row: (text, sprite)
+
+    def set_rows(self, rows):
+        """Set the text of each row, a dict of row: text. Rows left out are cleared."""
+        for row in list(self._rows):
+            if row not in rows:
+                del self._rows[row]
+        for row, text in rows.items():
+            if text and self._rows.get(row, (None,))[0] != text:
+                colour, alpha, ascent = text_sprite(text)
+                x, y = text_origin(row, self.height)
+                self._rows[row] = (text, Sprite(x - 1, y - ascent, colour, alpha).clipped(self.width, self.height))
+            elif not text:
+                self._rows.pop(row, None)
+
+    def draw(self, image, rows=None):
+        """Blend the HUD on to a BGR `image` in place, after setting the text `rows` if given. Returns the image."""
+        if rows is not None:
+            self.set_rows(rows)
+        for sprite in self._static:
+            sprite.blend(image)
+        for _, sprite in self._rows.values():
+            if sprite is not None:
+                sprite.blend(image)
+        return image
@@ -0,0 +1,169 @@
+"""
+Locate the drone in a room from a map of where the aruco markers are.
+
+A map file places any number of DICT_4X4_50 markers in the room frame: x and y horizontal, z up, in millimeters.
+Each marker has the position of its centre, and either the `facing` heading (degrees counter-clockwise from the x
+axis) of a marker hung upright on a wall, or the `rotation` of the marker frame in to the room frame as a Rodrigues
+vector (radians). The default is a marker lying face up on the floor. `size` defaults to MARKER_HEIGHT.
+
+    {
+      "version": 1,
+      "markers": [
+        {"id": 2, "position": [0, 2000, 1200], "facing": -90},
+        {"id": 3, "position": [500, 2000, 1200], "facing": -90, "size": 150},
+        {"id": 7, "position": [1500, 1000, 0]}
+      ]
+    }
+
+`Localizer.locate` solves one PnP over the corners of every mapped marker in a frame, so each extra marker in view
+adds constraints rather than another pose to reconcile, and markers can come and go without the pose jumping. The
+solve is warm started from the last pose when there was one; otherwise it starts from a global solution (SQPnP, or
+IPPE for one marker). Markers whose corners reproject badly, such as one moved since the map was made, are left out.
+"""
+
+import json
+from collections import namedtuple
+from math import atan2, cos, degrees, radians, sin
+import cv2.cv2 as cv2
+import numpy as np
+from aruco import MARKER_HEIGHT
+from calibresults import camera_matrix, dist_coeff
+from metrics import span
+
+MAP_VERSION = 1  # Format of the map files read and written here
+DICTIONARY_SIZE = 50  # Marker ids of DICT_4X4_50
+REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 1e-6)
+
+# Pose of the camera in the room. `position` is in mm, `rotation` turns camera axes in to room axes, and `heading`
+# is the direction the camera looks, in degrees counter-clockwise from the room x axis. `markers` is the number of
+# markers solved over, and `error` the RMS reprojection error of their corners in pixels.
+Pose = namedtuple('Pose', 'position rotation heading markers error rvec tvec')
+
+
+def marker_corners(size):
+    """Corners of a marker in its own frame, in the order aruco detects them."""
+    half = size / 2
+    return np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]], dtype=np.float64)
+
+
+def wall_rotation(facing):
+    """Rotation of an upright marker whose front faces the heading `facing` (degrees) in to the room frame."""
+    a = radians(facing)
+    normal = np.array([cos(a), sin(a), 0.0])
+    up = np.array([0.0, 0.0, 1.0])
+    return np.column_stack([np.cross(up, normal), up, normal])
+
+
+class MarkerMap:
+    """Room frame corners of each mapped marker, in an array with a row per marker."""
+    def __init__(self, markers):
+        self.markers = markers  # The marker entries, as in the file
+        self.ids = np.array([m['id'] for m in markers], dtype=np.int32)
+        self.corners = np.zeros((len(markers), 4, 3))
+        for row, marker in enumerate(markers):
+            if 'rotation' in marker:
+                rotation, _ = cv2.Rodrigues(np.array(marker['rotation'], dtype=float))
+            elif 'facing' in marker:
+                rotation = wall_rotation(marker['facing'])
+            else:
+                rotation = np.eye(3)
+            corners = marker_corners(marker.get('size', MARKER_HEIGHT))
+            self.corners[row] = corners @ rotation.T + np.array(marker['position'], dtype=float)
+        # Row of each marker id, or -1 if it is not on the map
+        self.rows = np.full(DICTIONARY_SIZE, -1, dtype=np.intp)
+        if len(set(self.ids.tolist())) < len(self.ids):
+            raise ValueError('A marker id is on the map more than once')
+        self.rows[self.ids] = np.arange(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, marker_id):
+        return 0 <= marker_id < DICTIONARY_SIZE and self.rows[marker_id] >= 0
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            marker_map = json.load(f)
+        if marker_map.get('version', 0) > MAP_VERSION:
+            raise ValueError('%s is map version %s, newer than this code reads (%d)' %
+                             (path, marker_map.get('version'), MAP_VERSION))
+        return cls(marker_map['markers'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'version': MAP_VERSION, 'markers': self.markers}, f, indent=2)
+
+
+class Localizer:
+    """Pose of the camera in the room from the mapped markers in each frame.
+    If given `undistort`, an `undistort.UndistortMap`, corners are undistorted through its lookup table.
+    Markers with a corner reprojecting more than `max_error` pixels away are left out of the solve, and if the
+    markers that are left still reproject worse than that on average, there is no pose for the frame.
+    If given `metrics`, the solve is timed as the 'locate' stage."""
+    def __init__(self, marker_map, undistort=None, max_error=4.0, metrics=None):
+        self.map = marker_map
+        self.undistort = undistort
+        self.max_error = max_error
+        self.metrics = metrics
+        self.pose = None  # The last pose found, which the next solve starts from
+        self.warm = 0  # Solves started from the last pose
+        self.cold = 0  # Solves started from scratch
+
+    def locate(self, markers):
+        """The Pose of the camera from `markers`, an `aruco.MarkerSet`, or None if no mapped marker gives one."""
+        with span(self.metrics, 'locate'):
+            rows = self.map.rows[np.clip(markers.ids, 0, DICTIONARY_SIZE - 1)]
+            seen = (markers.ids < DICTIONARY_SIZE) & (rows >= 0)
+            if not seen.any():
+                self.pose = None
+                return None
+            image_points = markers.corners[seen]
+            if self.undistort:
+                image_points, distortion = self.undistort.points(image_points), None
+            else:
+                distortion = dist_coeff
+            object_points = self.map.corners[rows[seen]]
+            image_points = image_points.astype(np.float64)
+            pose = None
+            if self.pose is not None:
+                self.warm += 1
+                pose = self._solve(object_points, image_points, distortion, self.pose)
+            if pose is None:  # No last pose, or the drone moved too far from it to converge
+                self.cold += 1
+                pose = self._solve(object_points, image_points, distortion)
+            self.pose = pose
+            return pose
+
+    def _solve(self, object_points, image_points, distortion, start=None):
+        """Solve from the Pose `start`, or from scratch, then drop the markers that do not fit and solve again
+        without them, until all the markers left fit."""
+        while True:
+            rvec, tvec = self._pnp(object_points, image_points, distortion, start)
+            projected, _ = cv2.projectPoints(object_points.reshape(-1, 3), rvec, tvec, camera_matrix, distortion)
+            errors = np.linalg.norm(projected.reshape(-1, 4, 2) - image_points, axis=2).max(axis=1)
+            fits = errors <= self.max_error
+            if fits.all() or len(errors) == 1:
+                break
+            if not fits.any():
+                fits = errors < errors.max()  # A bad marker can pull the rest off too, so drop only the worst
+                if not fits.any():
+                    break
+            object_points, image_points = object_points[fits], image_points[fits]
+        rms = float(np.sqrt(np.mean(np.square(projected.reshape(-1, 4, 2) - image_points).sum(axis=2))))
+        if rms > self.max_error:
+            return None
+        rotation = cv2.Rodrigues(rvec)[0].T  # Camera axes in to room axes
+        position = -rotation @ tvec.ravel()
+        forward = rotation[:, 2]  # Camera z axis, out through the lens
+        return Pose(position, rotation, degrees(atan2(forward[1], forward[0])), len(object_points), rms, rvec, tvec)
+
+    def _pnp(self, object_points, image_points, distortion, start=None):
+        """(rvec, tvec) of the room in the camera frame, refined from the Pose `start` or from a global solution."""
+        points = object_points.reshape(-1, 3), image_points.reshape(-1, 2)
+        if start is not None:
+            rvec, tvec = start.rvec.copy(), start.tvec.copy()
+        else:
+            method = cv2.SOLVEPNP_IPPE if len(object_points) == 1 else cv2.SOLVEPNP_SQPNP
+            _, rvec, tvec = cv2.solvePnP(*points, camera_matrix, distortion, flags=method)
+        return cv2.solvePnPRefineLM(*points, camera_matrix, distortion, rvec, tvec, REFINE_CRITERIA)
@@ -0,0 +1,140 @@
+"""
+Per-stage latency of the flight loop, in fixed memory.
+
+Time a stage with a named span:
+
+    with metrics.span('detect'):
+        tracker.update(frame.gray)
+
+or record a duration that was measured elsewhere with `record`. Each name gets a histogram with fixed log-spaced
+bins from 10 us to 10 s, so memory does not grow however long the flight is. `hud_text` gives a one line summary,
+and `tick` appends a summary as a JSON line to a file every `interval` seconds.
+
+The most important figure is camera-to-command: from when a frame was captured to when a command computed from it was
+sent. Capture times come from the frames' presentation timestamps (PTS), see `capture_time`.
+"""
+
+import json
+import threading
+import time
+from contextlib import nullcontext
+import numpy as np
+
+BINS_PER_DECADE = 20
+MIN_SECONDS, MAX_SECONDS = 1e-5, 10.0
+EDGES = np.logspace(np.log10(MIN_SECONDS), np.log10(MAX_SECONDS), int(6 * BINS_PER_DECADE) + 1)
+HUD_SPANS = ('decode', 'detect', 'pose', 'control', 'hud', 'camera_to_command')
+
+
+class Histogram:
+    """Counts of durations in fixed log-spaced bins."""
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = np.zeros(len(EDGES) + 1, dtype=np.int64)  # Plus under and overflow bins
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[np.searchsorted(EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """The duration below which `q` percent of the samples fall, to the resolution of the bins."""
+        if not self.count:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        if i == 0:
+            return MIN_SECONDS
+        if i >= len(EDGES):
+            return self.max
+        return min(float(np.sqrt(EDGES[i - 1] * EDGES[i])), self.max)  # Geometric middle of the bin
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p99': self.percentile(99), 'max': self.max}
+
+
+class Span:
+    """Context manager that records how long its block took."""
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Latency histograms by stage name."""
+    def __init__(self, path=None, interval=5.0):
+        self.path = path  # JSON lines file the summaries are appended to, if any
+        self.interval = interval
+        self.histograms = {}
+        self._lock = threading.Lock()  # Stages are timed on more than one thread
+        self._last_dump = time.time()
+        self._clock_offset = None  # Smallest (decode time - PTS) seen, to turn PTS into wall time
+
+    def span(self, name):
+        """Time a block as stage `name`."""
+        return Span(self, name)
+
+    def record(self, name, seconds):
+        """Record that stage `name` took `seconds`."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def capture_time(self, frame):
+        """Estimate the wall time a `video.Frame` was captured from its PTS.
+        The frame that arrived quickest after its PTS is taken to have had no delay, so the result is relative to
+        the fastest the stream has ever been. Frames without a PTS fall back to their decode time."""
+        if frame.time is None:
+            return frame.decode_time
+        offset = frame.decode_time - frame.time
+        if self._clock_offset is None or offset < self._clock_offset:
+            self._clock_offset = offset
+        return frame.time + self._clock_offset
+
+    def summary(self):
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in self.histograms.items()}
+
+    def hud_text(self, names=HUD_SPANS):
+        """One line of p50/p99 milliseconds for the stages `names`."""
+        parts = []
+        for name in names:
+            histogram = self.histograms.get(name)
+            if histogram is not None and histogram.count:
+                parts.append('%s %.1f/%.1f' % (name, histogram.percentile(50) * 1000, histogram.percentile(99) * 1000))
+        return 'ms p50/p99: ' + ' '.join(parts)
+
+    def dump(self):
+        """Append a summary of every stage to the JSON lines file."""
+        if not self.path:
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'spans': self.summary()}) + '\n')
+
+    def tick(self):
+        """Dump the summary if `interval` seconds have passed since the last dump."""
+        now = time.time()
+        if now - self._last_dump >= self.interval:
+            self._last_dump = now
+            self.dump()
+
+
+def span(metrics, name):
+    """`metrics.span(name)`, or a block that does nothing if `metrics` is None."""
+    return metrics.span(name) if metrics else nullcontext()
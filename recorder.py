@@ -0,0 +1,301 @@
+"""
+Record a flight, and play it back in place of the drone.
+
+A recording holds the raw H.264 video stream from `drone.get_video_stream()`, the flight and log data events, and
+the stick commands sent, each stamped with the time it arrived or was sent. The file is a header, then one record after another, then an index of where
+each record starts so a player can seek by time:
+
+    header:  MAGIC
+    record:  kind (uint8), time (float64 seconds from start), length (uint32), payload
+    index:   one (kind, time, offset) row per record
+    footer:  index offset (uint64), record count (uint32), MAGIC
+
+Video payloads are the bytes as read from the stream. Flight and log data payloads are JSON of their numeric fields,
+and command payloads JSON of the stick values (-100 to 100) that changed.
+If the footer is missing, e.g. the recorder was not closed, the records are scanned instead.
+
+`ReplayDrone` stands in for `tellopy.Tello` so `fly.main()` can be run offline from a recording:
+    python fly.py --replay flight.tello [--realtime]
+"""
+
+import bisect
+import json
+import struct
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+
+MAGIC = b'TELLOREC1\n'
+RECORD = struct.Struct('<BdI')
+FOOTER = struct.Struct('<QI')
+INDEX_DTYPE = np.dtype([('kind', '<u1'), ('time', '<f8'), ('offset', '<u8')])
+
+VIDEO, FLIGHT_DATA, LOG_DATA, COMMAND = 1, 2, 3, 4
+
+
+def _fields(data):
+    """The numeric fields of a tellopy data object."""
+    return {k: v for k, v in vars(data).items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+
+
+class Recorder:
+    """Write a recording of the video stream and telemetry events."""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._index = []
+        self._lock = threading.Lock()  # Video and telemetry arrive on different threads
+        self._start = time.time()
+
+    def write(self, kind, payload):
+        """Append a record of `kind` with `payload` bytes, stamped with the current time."""
+        with self._lock:
+            if self._file.closed:
+                return
+            t = time.time() - self._start
+            self._index.append((kind, t, self._file.tell()))
+            self._file.write(RECORD.pack(kind, t, len(payload)))
+            self._file.write(payload)
+
+    def handler(self, event, sender, data, **args):
+        """Subscribe this to EVENT_FLIGHT_DATA and EVENT_LOG_DATA to record them."""
+        drone = sender
+        if event is drone.EVENT_FLIGHT_DATA:
+            self.write(FLIGHT_DATA, json.dumps(_fields(data)).encode())
+        elif event is drone.EVENT_LOG_DATA:
+            fields = {'imu': _fields(data.imu), 'mvo': _fields(data.mvo)}
+            self.write(LOG_DATA, json.dumps(fields).encode())
+
+    def command(self, sticks):
+        """Record the stick values sent, a dict of axis: value."""
+        self.write(COMMAND, json.dumps(sticks).encode())
+
+    def stream(self, video_stream):
+        """Wrap a video stream so that everything read from it is recorded."""
+        return RecordingStream(video_stream, self)
+
+    def close(self):
+        """Write the index and footer, and close the file."""
+        with self._lock:
+            if self._file.closed:
+                return
+            offset = self._file.tell()
+            self._file.write(np.array(self._index, dtype=INDEX_DTYPE).tobytes())
+            self._file.write(FOOTER.pack(offset, len(self._index)))
+            self._file.write(MAGIC)
+            self._file.close()
+
+
+class RecordingStream:
+    """A video stream that records what is read through it."""
+    def __init__(self, video_stream, recorder):
+        self.video_stream = video_stream
+        self.recorder = recorder
+
+    def read(self, size):
+        data = self.video_stream.read(size)
+        if data:
+            self.recorder.write(VIDEO, data)
+        return data
+
+    def seek(self, offset, whence):
+        return -1
+
+
+class Recording:
+    """Read a recording."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        if not self.data.startswith(MAGIC):
+            raise ValueError('%s is not a recording' % path)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        """Read the index from the footer, or rebuild it by scanning the records."""
+        end = len(self.data) - len(MAGIC)
+        if self.data.endswith(MAGIC) and end - FOOTER.size >= len(MAGIC):
+            offset, count = FOOTER.unpack_from(self.data, end - FOOTER.size)
+            if offset + count * INDEX_DTYPE.itemsize == end - FOOTER.size:
+                return np.frombuffer(self.data, INDEX_DTYPE, count, offset)
+        rows = []
+        offset = len(MAGIC)
+        while offset + RECORD.size <= len(self.data):
+            kind, t, length = RECORD.unpack_from(self.data, offset)
+            if kind not in (VIDEO, FLIGHT_DATA, LOG_DATA, COMMAND) or offset + RECORD.size + length > len(self.data):
+                break  # Truncated record
+            rows.append((kind, t, offset))
+            offset += RECORD.size + length
+        return np.array(rows, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def record(self, i):
+        """Return (kind, time, payload bytes) of record `i`."""
+        kind, t, offset = self.index[i]
+        _, _, length = RECORD.unpack_from(self.data, offset)
+        start = int(offset) + RECORD.size
+        return int(kind), float(t), self.data[start:start + length]
+
+    def seek(self, t):
+        """The number of the first record at or after time `t`."""
+        return int(np.searchsorted(self.index['time'], t))
+
+    @property
+    def duration(self):
+        return float(self.index['time'][-1]) if len(self.index) else 0.0
+
+
+class FlightData(SimpleNamespace):
+    """Flight data played back from a recording. Prints like tellopy's FlightData."""
+    def __str__(self):
+        return ('ALT: %2d | SPD: %2d | BAT: %2d | WIFI: %2d | CAM: %2d | MODE: %2d' %
+                (self.height, self.ground_speed, self.battery_percentage, self.wifi_strength, self.camera_state, self.fly_mode))
+
+
+def _decode(kind, payload):
+    """Turn a telemetry payload back into an object with the same fields as tellopy's."""
+    fields = json.loads(payload.decode())
+    if kind == FLIGHT_DATA:
+        return FlightData(**fields)
+    return SimpleNamespace(imu=SimpleNamespace(**fields['imu']), mvo=SimpleNamespace(**fields['mvo']))
+
+
+class ReplayDrone:
+    """Stands in for `tellopy.Tello`, playing back a recording.
+    The video is read as fast as the reader consumes it, or at the recorded pace if `realtime`. Telemetry is not
+    published as the video is read, as the decoder reads ahead by however much it buffers. Instead the player of the
+    video calls `advance` with the record time of each frame, from `stream_time`, before acting on it, and the
+    telemetry events recorded up to then are published in order on its thread, so a replay is repeatable. `clock`
+    returns the time playback has been advanced to, for timing control code from the recording rather than the wall
+    clock. Commands are kept in `commands`."""
+    EVENT_FLIGHT_DATA = 'flight_data'
+    EVENT_LOG_DATA = 'log_data'
+
+    def __init__(self, path, realtime=False):
+        self.recording = Recording(path)
+        self.realtime = realtime
+        self.commands = []  # (time, command, value) of each command sent
+        self._handlers = {}
+        self._next = 0  # The next record to look for video in
+        self._next_event = 0  # The next record to look for telemetry in
+        self._time = 0.0
+        self._pending = b''
+        self._started = None
+        self._read = 0  # Bytes of video read
+        self._video_offsets = []  # Stream offset of the start of each video payload read
+        self._video_times = []  # and its record time
+
+    def clock(self):
+        """The time in the recording that playback has been advanced to."""
+        return self._time
+
+    def subscribe(self, event, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def connect(self):
+        pass
+
+    def wait_for_connection(self, timeout=None):
+        pass
+
+    def quit(self):
+        self._next = self._next_event = len(self.recording)
+
+    def get_video_stream(self):
+        return self
+
+    def seek(self, offset, whence):
+        return -1
+
+    def read(self, size):
+        """Return up to `size` bytes of video."""
+        while not self._pending and self._next < len(self.recording):
+            kind, t, payload = self.recording.record(self._next)
+            self._next += 1
+            if kind != VIDEO:
+                continue
+            if self.realtime:
+                if self._started is None:
+                    self._started = time.time() - t
+                delay = self._started + t - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self._video_offsets.append(self._read)
+            self._video_times.append(t)
+            self._pending = payload
+        data, self._pending = self._pending[:size], self._pending[size:]
+        self._read += len(data)
+        return data
+
+    def stream_time(self, position):
+        """The record time of the video payload that byte `position` of the video stream came in."""
+        i = bisect.bisect_right(self._video_offsets, position) - 1
+        return self._video_times[max(i, 0)] if self._video_times else 0.0
+
+    def advance(self, t):
+        """Publish the telemetry recorded up to time `t`, in order, and move the clock on to `t`."""
+        while self._next_event < len(self.recording):
+            kind, record_time, payload = self.recording.record(self._next_event)
+            if record_time > t:
+                break
+            self._next_event += 1
+            if kind in (VIDEO, COMMAND):  # The recorded commands are not replayed, the code under test sends its own
+                continue
+            self._time = max(self._time, record_time)
+            event = self.EVENT_FLIGHT_DATA if kind == FLIGHT_DATA else self.EVENT_LOG_DATA
+            data = _decode(kind, payload)
+            for handler in self._handlers.get(event, []):
+                handler(event=event, sender=self, data=data)
+        self._time = max(self._time, t)
+
+    def _command(self, name, value=None):
+        self.commands.append((self._time, name, value))
+
+    def takeoff(self):
+        self._command('takeoff')
+
+    def land(self):
+        self._command('land')
+
+    def emergency(self):
+        self._command('emergency')
+
+    def up(self, val):
+        self._command('up', val)
+
+    def down(self, val):
+        self._command('down', val)
+
+    def forward(self, val):
+        self._command('forward', val)
+
+    def backward(self, val):
+        self._command('backward', val)
+
+    def right(self, val):
+        self._command('right', val)
+
+    def left(self, val):
+        self._command('left', val)
+
+    def clockwise(self, val):
+        self._command('clockwise', val)
+
+    def counter_clockwise(self, val):
+        self._command('counter_clockwise', val)
+
+    def set_roll(self, roll):
+        self._command('roll', roll)
+
+    def set_pitch(self, pitch):
+        self._command('pitch', pitch)
+
+    def set_throttle(self, throttle):
+        self._command('throttle', throttle)
+
+    def set_yaw(self, yaw):
+        self._command('yaw', yaw)
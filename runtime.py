@@ -0,0 +1,121 @@
+"""
+Run the stages of a flight as asyncio tasks that talk through latest-value channels.
+
+Each stage (video ingest, detection, control, telemetry, display) is a coroutine that runs at its own rate. A stage
+publishes what it produces on a `Channel`, and the stages that use it either read the latest value whenever they run,
+or wait for a newer one. Values a slow reader missed are skipped rather than queued, so no stage falls behind another.
+
+Blocking or CPU heavy work (decoding, OpenCV) is passed to named thread pool executors with `Runtime.run_in`, so the
+event loop itself only schedules. Work that must not run concurrently with itself, such as a tracker that keeps
+state between frames, goes to a single worker executor.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generic, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class Channel(Generic[T]):
+    """Holds the latest value published. Readers wait for a value newer than the last one they saw.
+    `version` counts the values published, so a reader can tell whether it missed any."""
+    def __init__(self, name):
+        self.name = name
+        self.value: Optional[T] = None
+        self.version = 0
+        self.time = None  # Wall time the latest value was published
+        self._loop = None
+        self._changed = asyncio.Event()
+
+    def bind(self, loop):
+        """Set the loop that `publish_threadsafe` hands values to."""
+        self._loop = loop
+
+    def publish(self, value: T):
+        """Replace the value and wake every waiting reader. Call from the event loop."""
+        self.value = value
+        self.version += 1
+        self.time = time.time()
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish_threadsafe(self, value: T):
+        """Publish from another thread, e.g. a tellopy event handler. Before the loop runs, or after it has closed,
+        there is nobody to wake, so the value is only stored."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            self.value = value
+            self.version += 1
+            self.time = time.time()
+        else:
+            loop.call_soon_threadsafe(self.publish, value)
+
+    async def next(self, version=0) -> Tuple[T, int]:
+        """Wait for a value newer than `version`, and return it with its version."""
+        while self.version <= version:
+            await self._changed.wait()
+        return self.value, self.version
+
+    def __repr__(self):
+        return '<Channel %s v%d>' % (self.name, self.version)
+
+
+class Runtime:
+    """Runs stage coroutines together, with named channels and executors."""
+    def __init__(self):
+        self.channels = {}
+        self.executors = {}
+        self._loop = None
+
+    def channel(self, name) -> Channel:
+        """The channel called `name`, made on first use."""
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = Channel(name)
+            channel.bind(self._loop)
+        return channel
+
+    def executor(self, name, workers=1):
+        """The thread pool called `name`, made with `workers` threads on first use."""
+        executor = self.executors.get(name)
+        if executor is None:
+            executor = self.executors[name] = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        return executor
+
+    async def run_in(self, name, function, *args):
+        """Call `function(*args)` on the executor called `name`, and wait for the result."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor(name), function, *args)
+
+    async def run(self, *stages):
+        """Run the stage coroutines until the first one returns or raises, then cancel the rest.
+        An exception from a stage is raised from here."""
+        self._loop = asyncio.get_running_loop()
+        for channel in self.channels.values():
+            channel.bind(self._loop)
+        tasks = [asyncio.ensure_future(stage) for stage in stages]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for executor in self.executors.values():
+                executor.shutdown(wait=False)
+
+
+async def ticks(period):
+    """Yield every `period` seconds, on a fixed schedule so the rate does not drift. Ticks that are missed because
+    the loop was busy are skipped, not made up."""
+    loop = asyncio.get_running_loop()
+    next_time = loop.time()
+    while True:
+        yield next_time
+        next_time += period
+        now = loop.time()
+        if next_time < now:
+            next_time = now
+        await asyncio.sleep(next_time - now)
@@ -0,0 +1,91 @@
+"""
+Render synthetic camera views of aruco markers, as the Tello camera would see them.
+
+Markers are placed by their pose from the camera, in the same convention as `cv2.aruco.estimatePoseSingleMarkers`,
+and projected with the calibrated camera matrix. So detections on a rendered frame can be checked against the
+pose it was rendered with.
+"""
+
+import cv2.cv2 as cv2
+import numpy as np
+from math import radians
+from aruco import CAMERA_HEIGHT, CAMERA_WIDTH, MARKER_WIDTH
+from calibresults import camera_matrix, dist_coeff
+
+ARUCO_DICT = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+MARKER_IDS = 50  # Markers in ARUCO_DICT, so the most that can be in view at once without repeating an id
+CELLS = 6  # A 4x4 marker is 6 cells wide including its black border
+MARKER_PIXELS = 600  # Resolution the marker images are drawn at before being warped in to the frame
+
+
+def marker_image(marker_id):
+    """The printed marker: the marker with a one cell white quiet zone around it."""
+    cell = MARKER_PIXELS // CELLS
+    image = cv2.aruco.drawMarker(ARUCO_DICT, marker_id, MARKER_PIXELS)
+    return cv2.copyMakeBorder(image, cell, cell, cell, cell, cv2.BORDER_CONSTANT, value=255)
+
+
+def marker_pose(distance, x=0, y=0, yaw=0, roll=0):
+    """(rvec, tvec) of a marker facing the camera `distance` mm away, offset by x (right) and y (down) mm,
+    turned by `yaw` degrees (left edge closer when positive) and rolled by `roll` degrees."""
+    facing = np.diag([1.0, -1.0, -1.0])  # Marker z axis points back at the camera, y axis up
+    turn, _ = cv2.Rodrigues(np.array([0.0, -radians(yaw), 0.0]))
+    spin, _ = cv2.Rodrigues(np.array([0.0, 0.0, radians(roll)]))
+    rvec, _ = cv2.Rodrigues(turn @ facing @ spin)
+    return rvec.ravel(), np.array([x, y, distance], dtype=float)
+
+
+def grid_poses(count, distance, spacing=1.5, size=MARKER_WIDTH):
+    """Poses of `count` markers in a grid facing the camera, `spacing` marker widths apart."""
+    columns = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / columns))
+    step = spacing * size
+    poses = []
+    for i in range(count):
+        row, column = divmod(i, columns)
+        poses.append(marker_pose(distance, (column - (columns - 1) / 2) * step, (row - (rows - 1) / 2) * step))
+    return poses
+
+
+def render(markers, background=None, blur=0, noise=0, size=MARKER_WIDTH, seed=None):
+    """Render a BGR frame of `markers`, a list of (marker_id, rvec, tvec) or (marker_id, rvec, tvec, size).
+    `size` is the marker width in mm, of markers that do not give their own. `blur` is the Gaussian blur sigma in pixels, `noise` the standard deviation
+    of added pixel noise."""
+    if background is None:
+        frame = np.full((CAMERA_HEIGHT, CAMERA_WIDTH), 128, np.uint8)
+    else:
+        frame = cv2.cvtColor(background, cv2.COLOR_BGR2GRAY) if background.ndim == 3 else background.copy()
+    for marker_id, rvec, tvec, *marker_size in markers:
+        half = (marker_size[0] if marker_size else size) / 2 * (CELLS + 2) / CELLS  # Include the quiet zone
+        points = np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]], dtype=np.float64)
+        image = marker_image(marker_id)
+        corners, _ = cv2.projectPoints(points, np.asarray(rvec, float), np.asarray(tvec, float), camera_matrix, dist_coeff)
+        w = image.shape[0]
+        source = np.float32([[0, 0], [w, 0], [w, w], [0, w]])
+        warp = cv2.getPerspectiveTransform(source, corners.reshape(4, 2).astype(np.float32))
+        mask = cv2.warpPerspective(np.full_like(image, 255), warp, (CAMERA_WIDTH, CAMERA_HEIGHT))
+        warped = cv2.warpPerspective(image, warp, (CAMERA_WIDTH, CAMERA_HEIGHT))
+        np.copyto(frame, warped, where=mask > 127)
+    if blur:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur)
+    if noise:
+        rng = np.random.default_rng(seed)
+        frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def sequence(frames, distance, count=1, yaw=0, blur=0, noise=0, drift=2.0, seed=0):
+    """A list of `frames` BGR frames of `count` markers, `distance` mm away, drifting `drift` mm per frame to the right
+    and back, as when keeping station."""
+    if count > MARKER_IDS:
+        raise ValueError('At most %d markers can be in view, not %d' % (MARKER_IDS, count))
+    poses = grid_poses(count, distance)
+    images = []
+    for i in range(frames):
+        offset = drift * (i % 40 if i % 80 < 40 else 40 - i % 40)
+        markers = []
+        for marker_id, (rvec, tvec) in enumerate(poses):
+            rvec, tvec_yawed = marker_pose(tvec[2], tvec[0] + offset, tvec[1], yaw)
+            markers.append((marker_id, rvec, tvec_yawed))
+        images.append(render(markers, blur=blur, noise=noise, seed=seed + i))
+    return images
@@ -0,0 +1,429 @@
+"""
+Simulate a Tello in a room of aruco markers, in place of `tellopy.Tello`.
+
+`SimulatedTello` has the parts of tellopy's interface that `fly.py` uses: connect, subscribe, get_video_stream,
+takeoff, land, emergency, and the stick setters. Behind it:
+- The drone is a point with a heading. Each stick sets a target velocity (or yaw rate), which the drone reaches with
+  a first order lag, and it tilts with its acceleration, as a multirotor does.
+- The camera looks forward and CAMERA_TILT degrees down, and tilts with the drone. Its view of the markers on a
+  `markermap.MarkerMap` is rendered with `scene.render` and the calibrated intrinsics, and encoded to an H.264
+  stream, which `av.open(drone.get_video_stream())` decodes like the drone's.
+- Flight data and log data events are published, with the MVO velocities and IMU quaternion `estimator` reads.
+
+The link to the drone can be degraded. Every video packet, telemetry event and stick update is delayed by `latency`
+plus a random `jitter` (uniform from 0 to `jitter` seconds) and lost with probability `loss`. The video is cut into
+UDP sized packets, so loss corrupts frames the way it does over WiFi. `video_latency` adds the camera and encoder
+delay. Packets on each link keep their order, as they mostly do over one WiFi hop.
+
+    python fly.py --simulate [--map room.json] [--latency 0.05 --jitter 0.02 --loss 0.01]
+
+The top speeds, the time constant and the camera tilt below are assumed, not measured from a flight. Gains tuned
+in the simulator are a starting point for tuning on the drone (`tune.py` on a recording), not a substitute for it.
+"""
+
+import heapq
+import random
+import threading
+import time
+from collections import deque
+from fractions import Fraction
+from math import atan, cos, degrees, radians, sin
+from types import SimpleNamespace
+import av
+import cv2.cv2 as cv2
+import numpy as np
+import scene
+from aruco import CAMERA_HEIGHT, CAMERA_WIDTH
+from calibresults import camera_matrix
+from markermap import MarkerMap, marker_corners
+from recorder import FlightData
+
+PHYSICS_PERIOD = 1/200  # Seconds per integration step
+STICK_PERIOD = 1/50  # tellopy resends the stick state on a timer
+FLIGHT_DATA_PERIOD = 1/10
+LOG_DATA_PERIOD = 1/50
+MAX_SPEED = 1000  # mm/s at full roll or pitch stick
+MAX_CLIMB = 700  # mm/s at full throttle
+MAX_YAW_RATE = 100  # degrees/s at full yaw stick
+TIME_CONSTANT = 0.3  # Seconds for the velocity to close 63% of the gap to the stick's
+TAKEOFF_HEIGHT = 800  # mm
+CAMERA_TILT = 10  # Degrees the camera looks below the drone's forward axis
+GRAVITY = 9810  # mm/s^2
+PACKET_SIZE = 1460  # Bytes of video per UDP packet
+FRAME_RATE = 30
+GOP_SIZE = 30  # Frames between keyframes
+TIME_BASE = Fraction(1, 1000)
+
+# Markers the drone sees from the start without a map: a row on the wall 3 m ahead, with the target (2) in the middle
+DEFAULT_MARKERS = [{'id': i, 'position': [(i - 2) * 300, 3000, 800 + (i % 2) * 200], 'facing': -90} for i in range(5)]
+
+
+class Link:
+    """Delays and loses messages, keeping them in order."""
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = rng or random.Random()
+        self.sent = 0
+        self.lost = 0
+        self._last = 0.0
+
+    def arrival(self, now):
+        """When a message sent at `now` arrives, or None if it is lost."""
+        self.sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.lost += 1
+            return None
+        self._last = max(self._last, now + self.latency + self.rng.uniform(0, self.jitter))
+        return self._last
+
+
+def marker_poses(marker_map):
+    """(id, rotation, centre, size) of each marker on the map, in the room frame, from its corners."""
+    poses = []
+    for marker_id, corners in zip(marker_map.ids.tolist(), marker_map.corners):
+        x = corners[1] - corners[0]
+        y = corners[0] - corners[3]
+        size = np.linalg.norm(x)
+        x, y = x / size, y / np.linalg.norm(y)
+        poses.append((marker_id, np.column_stack([x, y, np.cross(x, y)]), corners.mean(axis=0), size))
+    return poses
+
+
+def body_rotation(heading, pitch, roll):
+    """Rotation of the drone body (x forward, y left, z up) in to the room frame. Angles in degrees, `heading`
+    counter-clockwise from the room x axis, `pitch` nose down and `roll` right side down positive."""
+    yaw_matrix, _ = cv2.Rodrigues(np.array([0.0, 0.0, radians(heading)]))
+    pitch_matrix, _ = cv2.Rodrigues(np.array([0.0, radians(pitch), 0.0]))
+    roll_matrix, _ = cv2.Rodrigues(np.array([radians(roll), 0.0, 0.0]))
+    return yaw_matrix @ pitch_matrix @ roll_matrix
+
+
+def quaternion(heading, pitch, roll):
+    """(q0, q1, q2, q3) of the attitude as the IMU reports it, with yaw increasing clockwise."""
+    phi, theta, psi = radians(roll) / 2, radians(pitch) / 2, radians(-heading) / 2
+    return (cos(phi) * cos(theta) * cos(psi) + sin(phi) * sin(theta) * sin(psi),
+            sin(phi) * cos(theta) * cos(psi) - cos(phi) * sin(theta) * sin(psi),
+            cos(phi) * sin(theta) * cos(psi) + sin(phi) * cos(theta) * sin(psi),
+            cos(phi) * cos(theta) * sin(psi) - sin(phi) * sin(theta) * cos(psi))
+
+
+class VideoStream:
+    """The encoded video as it arrives over the link, read by PyAV like tellopy's video stream."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = deque()  # (arrival time, bytes)
+        self.closed = False
+
+    def put(self, arrival, data):
+        with self._cond:
+            self._queue.append((arrival, data))
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, size):
+        """Up to `size` bytes of the packets that have arrived, waiting for the next one if none has.
+        No bytes means the stream has ended."""
+        with self._cond:
+            while not self._queue and not self.closed:
+                self._cond.wait(0.1)
+            if not self._queue:
+                return b''
+            arrival = self._queue[0][0]
+        delay = arrival - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        with self._cond:
+            data = b''
+            while self._queue and self._queue[0][0] <= time.time() and len(data) + len(self._queue[0][1]) <= size:
+                data += self._queue.popleft()[1]
+            if not data and self._queue:  # A packet larger than asked for
+                arrival, packet = self._queue.popleft()
+                data, rest = packet[:size], packet[size:]
+                self._queue.appendleft((arrival, rest))
+            return data
+
+    def seek(self, offset, whence):
+        return -1
+
+
+class SimulatedTello:
+    """Stands in for `tellopy.Tello`, flying a simulated drone in a room of markers.
+    The drone starts on the floor at `start` (x, y mm) facing `heading` degrees, in the room frame of `marker_map`.
+    Commands are kept in `commands`, and the drone's true state is in `position`, `velocity` and `heading`."""
+    EVENT_FLIGHT_DATA = 'flight_data'
+    EVENT_LOG_DATA = 'log_data'
+
+    def __init__(self, marker_map=None, start=(0, 0), heading=90, latency=0.0, jitter=0.0, loss=0.0,
+                 video_latency=0.0, frame_rate=FRAME_RATE, seed=None):
+        self.marker_map = marker_map or MarkerMap(DEFAULT_MARKERS)
+        self.markers = marker_poses(self.marker_map)
+        self.frame_rate = frame_rate
+        rng = random.Random(seed)
+        self.command_link = Link(latency, jitter, loss, rng)
+        self.telemetry_link = Link(latency, jitter, loss, rng)
+        self.video_link = Link(latency + video_latency, jitter, loss, rng)
+        self.commands = []  # (time, command, value) of each command sent
+        self.position = np.array([start[0], start[1], 0.0])  # mm
+        self.velocity = np.zeros(3)  # mm/s
+        self.heading = heading  # Degrees counter-clockwise from the room x axis
+        self.yaw_rate = 0.0  # Degrees/s counter-clockwise
+        self.pitch = 0.0  # Degrees, nose down
+        self.roll = 0.0  # Degrees, right side down
+        self.flying = False
+        self._target_height = None  # While taking off or landing
+        self._sticks = {'roll': 0.0, 'pitch': 0.0, 'throttle': 0.0, 'yaw': 0.0}  # As set, on the "controller"
+        self._applied = dict(self._sticks)  # As last received by the "drone"
+        self._stick_queue = []  # (arrival, sequence, sticks)
+        self._telemetry_queue = []  # (arrival, sequence, event, data)
+        self._sequence = 0
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._started = None
+        self._video = VideoStream()
+        self._threads = []
+
+    # tellopy interface
+
+    def subscribe(self, event, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def connect(self):
+        """Start the simulation: physics, telemetry and video."""
+        self._started = time.time()
+        for target, name in ((self._run_physics, 'SimulatedTello'), (self._run_camera, 'SimulatedCamera')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wait_for_connection(self, timeout=None):
+        pass
+
+    def quit(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(2.0)
+        self._video.close()
+
+    def get_video_stream(self):
+        return self._video
+
+    def takeoff(self):
+        self._command('takeoff')
+
+    def land(self):
+        self._command('land')
+
+    def emergency(self):
+        self._command('emergency')
+
+    def set_roll(self, roll):
+        self._stick('roll', roll)
+
+    def set_pitch(self, pitch):
+        self._stick('pitch', pitch)
+
+    def set_throttle(self, throttle):
+        self._stick('throttle', throttle)
+
+    def set_yaw(self, yaw):
+        self._stick('yaw', yaw)
+
+    def up(self, val):
+        self.set_throttle(val / 100)
+
+    def down(self, val):
+        self.set_throttle(-val / 100)
+
+    def forward(self, val):
+        self.set_pitch(val / 100)
+
+    def backward(self, val):
+        self.set_pitch(-val / 100)
+
+    def right(self, val):
+        self.set_roll(val / 100)
+
+    def left(self, val):
+        self.set_roll(-val / 100)
+
+    def clockwise(self, val):
+        self.set_yaw(val / 100)
+
+    def counter_clockwise(self, val):
+        self.set_yaw(-val / 100)
+
+    # Simulation
+
+    def clock(self):
+        """Seconds since the simulation started."""
+        return time.time() - self._started if self._started else 0.0
+
+    def _stick(self, axis, value):
+        self.commands.append((self.clock(), axis, value))
+        with self._lock:
+            self._sticks[axis] = max(-1.0, min(1.0, value))
+
+    def _command(self, name):
+        """Takeoff, land and emergency are sent once, and tellopy retries them until acknowledged, so they are
+        delayed but never lost."""
+        self.commands.append((self.clock(), name, None))
+        now = time.time()
+        with self._lock:
+            arrival = now + self.command_link.latency + self.command_link.rng.uniform(0, self.command_link.jitter)
+            self._push(self._stick_queue, arrival, name)
+
+    def _push(self, queue, arrival, *item):
+        self._sequence += 1
+        heapq.heappush(queue, (arrival, self._sequence) + item)
+
+    def _run_physics(self):
+        now = time.time()
+        next_stick = next_flight_data = next_log_data = now
+        while not self._stopped.is_set():
+            now += PHYSICS_PERIOD
+            delay = now - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                if now >= next_stick:
+                    next_stick += STICK_PERIOD
+                    arrival = self.command_link.arrival(now)
+                    if arrival is not None:
+                        self._push(self._stick_queue, arrival, dict(self._sticks))
+                while self._stick_queue and self._stick_queue[0][0] <= now:
+                    self._receive(heapq.heappop(self._stick_queue)[2])
+                self._step(PHYSICS_PERIOD)
+                if now >= next_flight_data:
+                    next_flight_data += FLIGHT_DATA_PERIOD
+                    self._send_telemetry(now, self.EVENT_FLIGHT_DATA, self._flight_data())
+                if now >= next_log_data:
+                    next_log_data += LOG_DATA_PERIOD
+                    self._send_telemetry(now, self.EVENT_LOG_DATA, self._log_data())
+                due = []
+                while self._telemetry_queue and self._telemetry_queue[0][0] <= now:
+                    due.append(heapq.heappop(self._telemetry_queue)[2:])
+            for event, data in due:  # Outside the lock, as handlers may send commands
+                for handler in self._handlers.get(event, []):
+                    handler(event=event, sender=self, data=data)
+
+    def _receive(self, message):
+        """Act on a stick update or command arriving at the drone."""
+        if isinstance(message, dict):
+            self._applied = message
+        elif message == 'takeoff' and not self.flying:
+            self.flying = True
+            self._target_height = TAKEOFF_HEIGHT
+        elif message == 'land' and self.flying:
+            self._target_height = 0.0
+        elif message == 'emergency':
+            self.flying = False
+            self._target_height = None
+            self.position[2] = 0.0  # The motors stop and it falls
+            self.velocity[:] = 0.0
+            self.yaw_rate = 0.0
+
+    def _step(self, dt):
+        """Advance the drone by `dt` seconds."""
+        if not self.flying:
+            self.pitch = self.roll = 0.0
+            return
+        sticks = self._applied
+        forward = np.array([cos(radians(self.heading)), sin(radians(self.heading)), 0.0])
+        right = np.array([forward[1], -forward[0], 0.0])
+        target = (forward * sticks['pitch'] + right * sticks['roll']) * MAX_SPEED
+        if self._target_height is None:
+            target[2] = sticks['throttle'] * MAX_CLIMB
+        else:  # Climbing to the takeoff height, or landing, on its own
+            target[2] = np.clip((self._target_height - self.position[2]) * 2, -MAX_CLIMB / 2, MAX_CLIMB / 2)
+            if abs(self._target_height - self.position[2]) < 10:
+                self.flying = self._target_height > 0
+                self._target_height = None
+        gain = 1 - np.exp(-dt / TIME_CONSTANT)
+        acceleration = (target - self.velocity) * gain / dt
+        self.velocity += acceleration * dt
+        self.position += self.velocity * dt
+        if self.position[2] < 0:
+            self.position[2] = self.velocity[2] = 0.0
+        self.yaw_rate += (-sticks['yaw'] * MAX_YAW_RATE - self.yaw_rate) * gain
+        self.heading = (self.heading + self.yaw_rate * dt + 180) % 360 - 180
+        # A multirotor tilts to accelerate
+        self.pitch = degrees(atan(acceleration @ forward / GRAVITY))
+        self.roll = degrees(atan(acceleration @ right / GRAVITY))
+
+    def _flight_data(self):
+        speed = np.hypot(self.velocity[0], self.velocity[1])
+        return FlightData(height=int(self.position[2] / 100), ground_speed=int(speed / 100), battery_percentage=100,
+                          wifi_strength=90, camera_state=0, fly_mode=6 if self.flying else 1,
+                          north_speed=int(self.velocity[1] / 100), east_speed=int(self.velocity[0] / 100),
+                          fly_time=int(self.clock() * 10))
+
+    def _log_data(self):
+        """MVO in the body frame (x forward, y left, z down, m/s and m), and the IMU attitude."""
+        rotation = body_rotation(self.heading, 0.0, 0.0)
+        velocity = rotation.T @ self.velocity / 1000
+        position = self.position / 1000
+        q0, q1, q2, q3 = quaternion(self.heading, self.pitch, self.roll)
+        mvo = SimpleNamespace(vel_x=velocity[0], vel_y=velocity[1], vel_z=-velocity[2],
+                              pos_x=position[0], pos_y=position[1], pos_z=-position[2])
+        imu = SimpleNamespace(q0=q0, q1=q1, q2=q2, q3=q3, gyro_z=-radians(self.yaw_rate))
+        return SimpleNamespace(imu=imu, mvo=mvo)
+
+    def _send_telemetry(self, now, event, data):
+        arrival = self.telemetry_link.arrival(now)
+        if arrival is not None:
+            self._push(self._telemetry_queue, arrival, event, data)
+
+    def camera_view(self):
+        """(id, rvec, tvec, size) of each marker in front of the camera, for `scene.render`."""
+        with self._lock:
+            body = body_rotation(self.heading, self.pitch, self.roll)
+            position = self.position.copy()
+        tilt = body_rotation(0.0, CAMERA_TILT, 0.0)
+        # Camera axes (x right, y down, z forward) in body axes (x forward, y left, z up)
+        axes = np.column_stack([(0.0, -1.0, 0.0), (0.0, 0.0, -1.0), (1.0, 0.0, 0.0)])
+        camera = body @ tilt @ axes  # Camera axes in to room axes
+        limit = np.array([CAMERA_WIDTH, CAMERA_HEIGHT]) / np.diag(camera_matrix)[:2] * 0.6  # Half the FOV, plus margin
+        view = []
+        for marker_id, rotation, centre, size in self.markers:
+            marker = camera.T @ rotation
+            tvec = camera.T @ (centre - position)
+            corners = marker_corners(size) @ marker.T + tvec
+            if (corners[:, 2] < 100).any() or marker[2, 2] > 0:
+                continue  # Behind the camera, or facing away
+            if (np.abs(corners[:, :2] / corners[:, 2:]) > limit).any():
+                continue  # Off the frame, where the distortion model no longer holds
+            view.append((marker_id, cv2.Rodrigues(marker)[0].ravel(), tvec, size))
+        return view
+
+    def _run_camera(self):
+        encoder = av.CodecContext.create('libx264', 'w')
+        encoder.width, encoder.height = CAMERA_WIDTH, CAMERA_HEIGHT
+        encoder.pix_fmt = 'yuv420p'
+        encoder.time_base = TIME_BASE
+        encoder.framerate = self.frame_rate
+        encoder.gop_size = GOP_SIZE
+        encoder.options = {'preset': 'ultrafast', 'tune': 'zerolatency', 'x264-params': 'repeat-headers=1'}
+        start = now = time.time()
+        while not self._stopped.is_set():
+            image = scene.render(self.camera_view())
+            frame = av.VideoFrame.from_ndarray(image, format='bgr24')
+            frame.pts = int((now - start) * 1000)
+            for packet in encoder.encode(frame):
+                data = bytes(packet)
+                for offset in range(0, len(data), PACKET_SIZE):
+                    arrival = self.video_link.arrival(now)
+                    if arrival is not None:
+                        self._video.put(arrival, data[offset:offset + PACKET_SIZE])
+            now += 1 / self.frame_rate
+            delay = now - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                now = time.time()  # Rendering is too slow for the frame rate, so drop the rate rather than lag
@@ -0,0 +1,210 @@
+"""
+Keep the drone's telemetry as numbers, in fixed memory, and look it up by time.
+
+tellopy hands out each flight data event (about 10 a second) and log data event (IMU and MVO, faster) as an object
+of Python attributes. `Telemetry` parses each in to a row of a fixed NumPy record dtype, FLIGHT_DTYPE or LOG_DTYPE,
+stamped with the time it arrived, and writes it in place in to a preallocated `RingBuffer`, which holds the last
+`capacity` rows of each. Rows can be looked up by time, e.g. the attitude when a frame was captured, or taken as
+columns over a window for batch work such as `estimator.quat2euler_array`.
+
+If given a spill directory, every `chunk` rows are also appended to a column file there, flight_data.tcol and
+log_data.tcol, so a whole flight is kept without the buffers growing:
+
+    header:  COLUMN_MAGIC, header length (uint32), JSON {"dtype": the dtype's descr}
+    chunk:   row count (uint32), then each field's column of that many values, in dtype order
+
+`load_columns` reads a column file back, reading only the fields asked for.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import numpy as np
+from estimator import quat2euler
+
+FLIGHT_FIELDS = ('height', 'north_speed', 'east_speed', 'ground_speed', 'fly_time', 'battery_percentage',
+                 'drone_battery_left', 'drone_fly_time_left', 'wifi_strength', 'light_strength', 'camera_state',
+                 'fly_mode', 'em_sky', 'em_ground', 'em_open', 'battery_low')
+IMU_FIELDS = ('acc_x', 'acc_y', 'acc_z', 'gyro_x', 'gyro_y', 'gyro_z', 'q0', 'q1', 'q2', 'q3', 'vg_x', 'vg_y', 'vg_z')
+MVO_FIELDS = ('vel_x', 'vel_y', 'vel_z', 'pos_x', 'pos_y', 'pos_z')
+FLIGHT_DTYPE = np.dtype([('time', '<f8')] + [(name, '<i2') for name in FLIGHT_FIELDS])
+LOG_DTYPE = np.dtype([('time', '<f8')] + [(name, '<f4') for name in IMU_FIELDS + MVO_FIELDS])
+COLUMN_MAGIC = b'TELLOCOL1\n'
+COUNT = struct.Struct('<I')
+
+
+def fill(row, names, source):
+    """Set the fields `names` of `row` in place from the attributes of the same name of `source`, or 0 if missing."""
+    for name in names:
+        row[name] = getattr(source, name, 0)
+
+
+def make_row(dtype, time, *parts):
+    """A new row of `dtype` at `time`, with its other fields from (names, source) `parts`, see `fill`."""
+    row = np.zeros(1, dtype)[0]
+    row['time'] = time
+    for names, source in parts:
+        fill(row, names, source)
+    return row
+
+
+class ColumnWriter:
+    """Append chunks of rows of `dtype` to a column file."""
+    def __init__(self, path, dtype):
+        self.dtype = dtype
+        self._file = open(path, 'wb')
+        header = json.dumps({'dtype': dtype.descr}).encode()
+        self._file.write(COLUMN_MAGIC + COUNT.pack(len(header)) + header)
+
+    def write(self, rows):
+        """Append `rows`, a structured array of the writer's dtype, as one chunk."""
+        self._file.write(COUNT.pack(len(rows)))
+        for name in self.dtype.names:
+            self._file.write(np.ascontiguousarray(rows[name]).tobytes())
+
+    def close(self):
+        self._file.close()
+
+
+def load_columns(path, names=None):
+    """Read a column file, or only the fields `names` of it, as one structured array of all its rows."""
+    with open(path, 'rb') as f:
+        if f.read(len(COLUMN_MAGIC)) != COLUMN_MAGIC:
+            raise ValueError('%s is not a telemetry column file' % path)
+        length, = COUNT.unpack(f.read(COUNT.size))
+        dtype = np.dtype([tuple(field) for field in json.loads(f.read(length).decode())['dtype']])
+        names = dtype.names if names is None else tuple(names)
+        chunks = []
+        while True:
+            size = f.read(COUNT.size)
+            if len(size) < COUNT.size:
+                break
+            count, = COUNT.unpack(size)
+            chunk = np.empty(count, np.dtype([(name, dtype[name]) for name in names]))
+            for name in dtype.names:
+                column = dtype[name].itemsize * count
+                if name in names:
+                    chunk[name] = np.frombuffer(f.read(column), dtype[name], count)
+                else:
+                    f.seek(column, os.SEEK_CUR)
+            chunks.append(chunk)
+    return np.concatenate(chunks) if chunks else np.empty(0, np.dtype([(name, dtype[name]) for name in names]))
+
+
+class RingBuffer:
+    """The last `capacity` rows of a record dtype with a 'time' field, in preallocated memory.
+    Rows must be appended in time order. If given `spill`, a `ColumnWriter`, every `chunk` rows appended are also
+    written to it, so `capacity` must be a whole number of chunks. Rows are appended on one thread, e.g. tellopy's,
+    and can be read from any."""
+    def __init__(self, dtype, capacity=4096, spill=None, chunk=256):
+        if spill and capacity % chunk:
+            raise ValueError('The capacity (%d) must be a whole number of chunks (%d)' % (capacity, chunk))
+        self.dtype = dtype
+        self.capacity = capacity
+        self.spill = spill
+        self.chunk = chunk
+        self.count = 0  # Rows appended in all, including those overwritten since
+        self._rows = np.zeros(capacity, dtype)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time, *parts):
+        """Write a row at `time`, with its other fields from (names, source) `parts`, see `fill`. Returns a copy."""
+        with self._lock:
+            row = self._rows[self.count % self.capacity]
+            row['time'] = time
+            for names, source in parts:
+                fill(row, names, source)
+            self.count += 1
+            if self.spill and self.count % self.chunk == 0:
+                start = (self.count - self.chunk) % self.capacity
+                self.spill.write(self._rows[start:start + self.chunk])
+            return row.copy()
+
+    def _find(self, t):
+        """Physical index of the newest row at or before time `t`, or -1 if there is none."""
+        times = self._rows['time']
+        if self.count <= self.capacity:
+            return int(np.searchsorted(times[:self.count], t, side='right')) - 1
+        head = self.count % self.capacity  # The oldest row, with the newest rows before it
+        newer = int(np.searchsorted(times[:head], t, side='right'))
+        if newer:
+            return newer - 1
+        older = int(np.searchsorted(times[head:], t, side='right'))
+        return head + older - 1 if older else -1
+
+    def at(self, t):
+        """A copy of the newest row at or before time `t`, or None if all the rows kept are later."""
+        with self._lock:
+            i = self._find(t)
+            return self._rows[i].copy() if i >= 0 else None
+
+    def latest(self):
+        """A copy of the newest row, or None if there is none yet."""
+        with self._lock:
+            return self._rows[(self.count - 1) % self.capacity].copy() if self.count else None
+
+    def window(self, start=-np.inf, end=np.inf):
+        """The rows kept with `start` <= time <= `end`, oldest first, as a new array."""
+        with self._lock:
+            head = self.count % self.capacity
+            if self.count <= self.capacity:
+                rows = self._rows[:self.count].copy()
+            else:
+                rows = np.concatenate((self._rows[head:], self._rows[:head]))
+        times = rows['time']
+        return rows[np.searchsorted(times, start, side='left'):np.searchsorted(times, end, side='right')]
+
+    def close(self):
+        """Spill the rows not written yet, if spilling, and close the spill."""
+        if not self.spill:
+            return
+        with self._lock:
+            pending = self.count % self.chunk
+            if pending:
+                start = (self.count - pending) % self.capacity
+                self.spill.write(self._rows[start:start + pending])
+            self.spill.close()
+            self.spill = None
+
+
+class Telemetry:
+    """Flight data and log data rows, in a `RingBuffer` each, stamped with the time from `clock` as they arrive.
+    If given `spill_dir`, the rows are also appended to column files there."""
+    def __init__(self, capacity=4096, clock=time.time, spill_dir=None, chunk=256):
+        self.clock = clock
+        spills = (None, None)
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            spills = (ColumnWriter(os.path.join(spill_dir, 'flight_data.tcol'), FLIGHT_DTYPE),
+                      ColumnWriter(os.path.join(spill_dir, 'log_data.tcol'), LOG_DTYPE))
+        self.flight = RingBuffer(FLIGHT_DTYPE, capacity, spills[0], chunk)
+        self.log = RingBuffer(LOG_DTYPE, capacity, spills[1], chunk)
+
+    def add(self, event, sender, data):
+        """Store a tellopy flight or log data event. Returns a copy of its row, or None for other events."""
+        drone = sender
+        if event is drone.EVENT_FLIGHT_DATA:
+            return self.flight.append(self.clock(), (FLIGHT_FIELDS, data))
+        if event is drone.EVENT_LOG_DATA:
+            return self.log.append(self.clock(), (IMU_FIELDS, data.imu), (MVO_FIELDS, data.mvo))
+        return None
+
+    def handler(self, event, sender, data, **args):
+        """Store tellopy's telemetry events. Subscribe this to the drone's flight and log data events."""
+        self.add(event, sender, data)
+
+    def attitude(self, t):
+        """(roll, pitch, yaw) in degrees from the last IMU row at or before time `t`, or None if there is none."""
+        row = self.log.at(t)
+        if row is None:
+            return None
+        return quat2euler(row['q0'], row['q1'], row['q2'], row['q3'])
+
+    def close(self):
+        self.flight.close()
+        self.log.close()
@@ -31,6 +31,7 @@ import argparse
 import time
 import cv2
 import imutils
+import numpy as np
 from imutils.video import VideoStream
 
 def main():
@@ -185,6 +186,114 @@ class Tracker:
             self.yoffset = 0
         return self.xoffset, self.yoffset
 
+
+# One row per colour in the result of ColourTracker.track
+RESULT_DTYPE = np.dtype([('name', 'U16'), ('found', '?'), ('x', 'f4'), ('y', 'f4'), ('radius', 'f4'),
+                         ('xoffset', 'i4'), ('yoffset', 'i4')])
+
+
+def channel_luts(colours):
+    """Per channel lookup tables from H, S and V to a bit mask of the colour ranges the value is in.
+    A pixel is in range i when bit i is set in all three of its lookups. Hue ranges with lower > upper wrap
+    around through red, e.g. (170, 50, 50) to (10, 255, 255)."""
+    values = np.arange(256)
+    luts = np.zeros((3, 256), np.uint8)
+    for bit, (lower, upper) in enumerate(colours.values()):
+        for channel in range(3):
+            if lower[channel] <= upper[channel]:
+                inside = (values >= lower[channel]) & (values <= upper[channel])
+            else:
+                inside = (values >= lower[channel]) | (values <= upper[channel])
+            luts[channel, inside] |= 1 << bit
+    return luts
+
+
+class ColourTracker:
+    """
+    Track the largest blob of each of several colours, in one pass over the frame.
+
+    `colours` is a dict of name: (HSV lower, HSV upper). The frame is shrunk by `scale` (area averaging
+    stands in for the blur), converted to HSV once, and every pixel is classified against all the colour ranges
+    at once through per channel lookup tables. Once every colour has been found, only a region of interest (ROI)
+    around where each is predicted to be next is searched, with a full scan every `full_scan_interval` frames.
+    """
+
+    def __init__(self, height, width, colours, scale=0.25, min_radius=10, roi_padding=3.0, full_scan_interval=10):
+        if len(colours) > 8:
+            raise ValueError('At most 8 colours can be tracked, got %d' % len(colours))
+        self.height = height
+        self.width = width
+        self.colours = colours
+        self.scale = scale
+        self.min_radius = min_radius  # Blobs smaller than this (full resolution pixels) are ignored
+        self.roi_padding = roi_padding  # Radii of margin around the predicted blobs
+        self.full_scan_interval = full_scan_interval
+        self.midx = int(width / 2)
+        self.midy = int(height / 2)
+        self.luts = channel_luts(colours)
+        self.kernel = np.ones((3, 3), np.uint8)
+        self.result = np.zeros(len(colours), RESULT_DTYPE)
+        self.result['name'] = list(colours)
+        self.roi = (0, 0, width, height)  # Region searched in the last frame
+        self._previous = None
+        self._frames_since_scan = 0
+
+    def _predict_roi(self):
+        """The region to search next, from the last two results, or the whole frame."""
+        result, previous = self.result, self._previous
+        self._frames_since_scan += 1
+        if (previous is None or not result['found'].all() or not previous['found'].all()
+                or self._frames_since_scan >= self.full_scan_interval):
+            self._frames_since_scan = 0
+            return 0, 0, self.width, self.height
+        x = 2 * result['x'] - previous['x']  # Constant velocity
+        y = 2 * result['y'] - previous['y']
+        margin = result['radius'] * (1 + self.roi_padding) + np.hypot(x - result['x'], y - result['y'])
+        x0, y0 = int(max(0, (x - margin).min())), int(max(0, (y - margin).min()))
+        x1, y1 = int(min(self.width, (x + margin).max())), int(min(self.height, (y + margin).max()))
+        if x1 <= x0 or y1 <= y0:
+            self._frames_since_scan = 0
+            return 0, 0, self.width, self.height
+        return x0, y0, x1, y1
+
+    def track(self, frame):
+        """Find each colour in a BGR frame. Returns a structured array with one row per colour, of its name,
+        whether it was found, its centre and radius in pixels, and its offset from the centre of the frame
+        (y up) as from Tracker.track."""
+        x0, y0, x1, y1 = self.roi = self._predict_roi()
+        small = cv2.resize(frame[y0:y1, x0:x1], None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        h, s, v = cv2.split(cv2.cvtColor(small, cv2.COLOR_BGR2HSV))
+        classes = cv2.bitwise_and(cv2.bitwise_and(cv2.LUT(h, self.luts[0]), cv2.LUT(s, self.luts[1])),
+                                  cv2.LUT(v, self.luts[2]))
+
+        result = np.zeros_like(self.result)
+        result['name'] = self.result['name']
+        for bit in range(len(self.colours)):
+            mask = cv2.morphologyEx(cv2.compare(cv2.bitwise_and(classes, 1 << bit), 0, cv2.CMP_GT),
+                                    cv2.MORPH_OPEN, self.kernel)
+            count, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            if count < 2:
+                continue
+            largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))  # Label 0 is the background
+            radius = max(stats[largest, cv2.CC_STAT_WIDTH], stats[largest, cv2.CC_STAT_HEIGHT]) / 2 / self.scale
+            if radius <= self.min_radius:
+                continue
+            x = (centroids[largest, 0] + 0.5) / self.scale - 0.5 + x0
+            y = (centroids[largest, 1] + 0.5) / self.scale - 0.5 + y0
+            result[bit] = (self.result['name'][bit], True, x, y, radius, int(x - self.midx), int(self.midy - y))
+
+        self._previous, self.result = self.result, result
+        return result
+
+    def draw(self, frame):
+        """Circle each colour found, and draw its offset arrow from the centre."""
+        for row in self.result[self.result['found']]:
+            centre = (int(row['x']), int(row['y']))
+            cv2.circle(frame, centre, int(row['radius']), (0, 255, 255), 2)
+            cv2.arrowedLine(frame, (self.midx, self.midy), centre, (0, 0, 255), 2)
+        return frame
+
+
 if __name__ == '__main__':
     main()
 
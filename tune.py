@@ -0,0 +1,273 @@
+"""
+Tune the PID gains offline, by simulating thousands of gain combinations at once.
+
+Each controller in `fly.py` turns an error from the estimator in to a stick command: control_yaw turns the x offset
+of the target (mm) in to yaw, control_z the y offset (mm) in to throttle, and control_y the angle of the target
+(degrees) in to roll. For tuning, the drone is modelled per axis as a plant: the error changes at a rate that
+follows `gain` x stick, `delay` seconds later (video, radio and processing latency), with a first order lag of
+`time_constant` seconds (the drone speeding up). The plant is either given, or identified from a recording made with
+`fly.py --record`, which has the stick commands sent and the drone's response:
+- from the error trace, by running the recorded video through the tracker as `fly.py` does, or
+- from the telemetry, by the MVO climb rate (z) or the IMU yaw rate (yaw). This is the cleaner of the two where it
+  measures the axis, as the error trace is only as good as the detections, and is timed by when the video arrived.
+
+Every combination of Kp, Ki, Kd, sample time and output limit is then run on the plant as one set of NumPy arrays,
+stepping all of them together through a step response, with the same update rules as `simple_pid.PID`. They are
+ranked by settling time, plus weighted overshoot and command effort. Gains have the sign that gives negative feedback
+on the plant.
+
+Usage:
+python tune.py --axis yaw --plant -150 0.3 0.2
+python tune.py --axis z --recording flight.tello --source telemetry
+"""
+
+import argparse
+import itertools
+import json
+import time
+from collections import namedtuple
+from math import exp
+import av
+import numpy as np
+from aruco import Tracker
+from estimator import quat2euler_array
+from fly import CONTROL_PERIOD, MAX_SPEED, PID_GAINS, PID_SAMPLE_TIME, TARGET_ID, calc_gluideslope
+from recorder import COMMAND, LOG_DATA, Recording, ReplayDrone
+from telemetry import Telemetry
+from video import Frame, keyframe_start
+
+# Controller name in fly.py: (stick it commands, index of its error in `Tracker.calc_error`, error units)
+AXES = {
+    'y': ('roll', 2, 'degrees'),
+    'z': ('throttle', 1, 'mm'),
+    'yaw': ('yaw', 0, 'mm'),
+}
+DEFAULT_STEPS = {'y': 20.0, 'z': 300.0, 'yaw': 300.0}  # Initial error of the step response, without a recording
+IDENTIFY_PERIOD = 1/50  # Seconds per sample when identifying a plant
+SIMULATION_PERIOD = 1/240  # Seconds per step of the plant in the simulation
+SETTLED = 0.05  # Settled once the error stays within this fraction of the step
+
+# The error changes at a rate that follows gain x stick (-100 to 100), `delay` seconds later, with a first order lag
+Plant = namedtuple('Plant', 'gain time_constant delay')
+
+
+def identify(times, sticks, rate_times, rates, period=IDENTIFY_PERIOD, max_delay=0.6):
+    """Fit a Plant to stick commands (held from each time in `times` to the next) and the rate the error changed at.
+    Every delay up to `max_delay` is tried, and the one with the least squares fit kept. Returns (plant, R squared).
+    Only the samples from the first stick movement on are used, as the drone climbs on its own after taking off."""
+    moved = np.flatnonzero(sticks)
+    first = times[moved[0]] if len(moved) else times[0]
+    grid = np.arange(max(first, rate_times[0]), rate_times[-1], period)
+    u = np.asarray(sticks, dtype=float)[np.clip(np.searchsorted(times, grid, side='right') - 1, 0, None)]
+    r = np.interp(grid, rate_times, rates)
+    best = None
+    for lag in range(int(max_delay / period) + 1):
+        # r[k + 1] = a r[k] + b u[k - lag]
+        x = np.column_stack([r[lag:-1], u[:len(u) - lag - 1]])
+        y = r[lag + 1:]
+        (a, b), residual, *_ = np.linalg.lstsq(x, y, rcond=None)
+        error = float(residual[0]) if len(residual) else float(np.sum(np.square(x @ (a, b) - y)))
+        if best is None or error < best[0]:
+            best = error, a, b, lag, float(np.sum(np.square(y - y.mean())))
+    error, a, b, lag, total = best
+    a = min(max(a, 1e-6), 1 - 1e-6)  # A stable lag
+    plant = Plant(b / (1 - a), -period / np.log(a), lag * period)
+    return plant, 1 - error / total if total else 0.0
+
+
+def read_recording(path, axis):
+    """The stick commands for `axis`, the error trace and the telemetry in a recording.
+    Returns a dict of 'commands' (times, values), 'errors' (times, errors, distances) and 'log_data' (the rows of
+    `telemetry.LOG_DTYPE`)."""
+    stick, _, _ = AXES[axis]
+    recording = Recording(path)
+    command_times, commands = [0.0], [0.0]
+    for i in np.flatnonzero(recording.index['kind'] == COMMAND):
+        _, t, payload = recording.record(i)
+        sticks = json.loads(payload.decode())
+        if stick in sticks:
+            command_times.append(t)
+            commands.append(sticks[stick])
+    drone = ReplayDrone(path)
+    log_count = int(np.count_nonzero(recording.index['kind'] == LOG_DATA))
+    telemetry = Telemetry(capacity=max(1, log_count), clock=drone.clock)
+    drone.subscribe(drone.EVENT_LOG_DATA, telemetry.handler)
+    tracker = Tracker(pyramid=True)
+    reticle = calc_gluideslope(-5)
+    error_times, errors, distances = [], [], []
+    for packet, frame in keyframe_start(av.open(drone.get_video_stream()).demux(video=0)):
+        if packet.pos is not None and packet.pos >= 0:
+            drone.advance(drone.stream_time(packet.pos + max(packet.size, 1) - 1))
+        tracker.update(Frame(frame).gray)
+        if TARGET_ID in tracker.marker_set:
+            error_times.append(drone.clock())
+            errors.append(tracker.calc_error(TARGET_ID, reticle))
+            distances.append(tracker.marker_set.distances[tracker.marker_set.row(TARGET_ID)])
+    drone.advance(float('inf'))  # The telemetry after the last frame
+    return {'commands': (np.array(command_times), np.array(commands)),
+            'errors': (np.array(error_times), np.array(errors).reshape(-1, 3), np.array(distances)),
+            'log_data': telemetry.log.window()}
+
+
+def error_rates(signals, axis, source='trace'):
+    """(times, rates) at which the error of `axis` changed, from the error trace or the telemetry."""
+    error_times, errors, distances = signals['errors']
+    if source == 'trace':
+        if len(error_times) < 10:
+            raise ValueError('The target (marker %d) is in too few frames to identify from' % TARGET_ID)
+        # Frames decoded from one read of the stream share a time, so keep the last of each
+        last = len(error_times) - 1 - np.unique(error_times[::-1], return_index=True)[1]
+        error_times, error = error_times[last], errors[last, AXES[axis][1]]
+        error = np.convolve(error, np.ones(5) / 5, mode='same')  # Smooth detection noise
+        return error_times, np.gradient(error, error_times)
+    log_data = signals['log_data']
+    log_times = log_data['time']
+    if axis == 'z':
+        return log_times, log_data['vel_z'] * 1000.0  # Climbing moves the target down
+    if axis == 'yaw':
+        distance = np.median(distances) if len(distances) else 2000.0
+        yaw = np.unwrap(np.radians(quat2euler_array(log_data['q0'], log_data['q1'], log_data['q2'], log_data['q3'])[2]))
+        return log_times, -np.gradient(yaw, log_times) * distance  # Turning clockwise moves the target left
+    raise ValueError('No telemetry measures the rate of the %s error, use --source trace' % axis)
+
+
+def simulate(plant, kp, ki, kd, sample_time, limit, step, duration=5.0, period=SIMULATION_PERIOD,
+             control_period=CONTROL_PERIOD):
+    """Step responses of `plant` from an error of `step` under every candidate controller at once.
+    The controller parameters are arrays with one element per candidate. The controllers are called every
+    `control_period`, and update as `simple_pid.PID` does: only once `sample_time` has passed since the last update,
+    proportional on the error, integral clamped to the output limits, derivative on the measurement. Unlike
+    simple_pid, the sample time is compared with a small tolerance, so a whole number of control periods is never
+    held back a period by rounding.
+    Returns a dict of arrays, one element per candidate: 'settling' time (s, inf if it never settles), 'overshoot' (a
+    fraction of the step), 'effort' (integral of |stick| dt) and the 'final' error."""
+    count = len(kp)
+    error = np.full(count, float(step))
+    rate = np.zeros(count)
+    delay_steps = int(round(plant.delay / period))
+    history = np.zeros((delay_steps + 1, count))  # Stick commands in flight, a ring
+    output = np.zeros(count)
+    integral = np.zeros(count)
+    last_input = error.copy()
+    last_time = np.zeros(count)
+    updated = np.zeros(count, dtype=bool)
+    lag = 1 - exp(-period / plant.time_constant)
+    control_steps = max(1, int(round(control_period / period)))
+    band = SETTLED * abs(step)
+    settling = np.zeros(count)
+    overshoot = np.zeros(count)
+    effort = np.zeros(count)
+    sign = np.sign(step)
+    with np.errstate(over='ignore', invalid='ignore'):
+        for i in range(int(duration / period)):
+            t = i * period
+            if i % control_steps == 0:
+                elapsed = t - last_time
+                update = ~updated | (elapsed >= sample_time - 1e-9)
+                dt = np.maximum(elapsed, 1e-16)
+                proportional = -kp * error
+                new_integral = np.clip(integral - ki * error * dt, -limit, limit)
+                derivative = -kd * (error - last_input) / dt
+                new_output = np.clip(proportional + new_integral + derivative, -limit, limit)
+                output = np.where(update, new_output, output)
+                integral = np.where(update, new_integral, integral)
+                last_input = np.where(update, error, last_input)
+                last_time = np.where(update, t, last_time)
+                updated |= update
+            history[i % (delay_steps + 1)] = output
+            delayed = history[(i + 1) % (delay_steps + 1)]  # Sent `delay_steps` steps ago
+            rate += (plant.gain * delayed - rate) * lag
+            error += rate * period
+            settling = np.where(np.abs(error) > band, t + period, settling)
+            overshoot = np.maximum(overshoot, -sign * error / abs(step))
+            effort += np.abs(output) * period
+    settling[~np.isfinite(error) | (settling >= duration - period)] = np.inf
+    return {'settling': settling, 'overshoot': np.nan_to_num(overshoot, nan=np.inf), 'effort': effort, 'final': error}
+
+
+def candidates(plant, kp, ki, kd, sample_times, limits):
+    """Every combination of the gain magnitudes, sample times and limits, as arrays. Gains get the sign of the plant
+    gain, which is the negative feedback sign for simple_pid (it outputs Kp x (setpoint - input))."""
+    grid = np.array(list(itertools.product(kp, ki, kd, sample_times, limits)), dtype=float).T
+    sign = np.sign(plant.gain) or 1.0
+    return {'kp': sign * grid[0], 'ki': sign * grid[1], 'kd': sign * grid[2], 'sample_time': grid[3],
+            'limit': grid[4]}
+
+
+def rank(results, overshoot_weight=2.0, effort_weight=0.01):
+    """Candidate indices from best to worst, and their scores: settling time plus weighted overshoot and effort."""
+    score = results['settling'] + overshoot_weight * results['overshoot'] + effort_weight * results['effort']
+    return np.argsort(score, kind='stable'), score
+
+
+def gain_range(current, count):
+    """Gain magnitudes from a tenth of to ten times `current`, plus zero."""
+    return np.concatenate([[0.0], abs(current) * np.logspace(-1, 1, count)])
+
+
+def main(axis, plant=None, recording=None, source='trace', step=None, count=12, top=10, duration=5.0,
+         overshoot_weight=2.0, effort_weight=0.01):
+    """Identify the plant for `axis` if not given, search the gains, and print the best."""
+    if plant is None:
+        signals = read_recording(recording, axis)
+        command_times, commands = signals['commands']
+        if len(command_times) < 3:
+            raise ValueError('%s has no %s commands, record a flight with this version of fly.py' %
+                             (recording, AXES[axis][0]))
+        rate_times, rates = error_rates(signals, axis, source)
+        plant, fit = identify(command_times, commands, rate_times, rates)
+        print('Identified %s from the %s: gain %.3g %s/s per stick, time constant %.3f s, delay %.3f s, R^2 %.2f' %
+              (axis, source, plant.gain, AXES[axis][2], plant.time_constant, plant.delay, fit))
+        if step is None and len(signals['errors'][1]):
+            step = float(np.percentile(np.abs(signals['errors'][1][:, AXES[axis][1]]), 95))
+    step = step or DEFAULT_STEPS[axis]
+    current = PID_GAINS[axis]
+    grid = candidates(plant, gain_range(current[0], count), gain_range(current[1], count // 2),
+                      gain_range(current[2], count // 2), [PID_SAMPLE_TIME, 1/30, 1/15, 1/10],
+                      [MAX_SPEED / 2, MAX_SPEED, MAX_SPEED * 1.5])
+    baseline = {k: np.array([v]) for k, v in zip(('kp', 'ki', 'kd'), current)}
+    baseline.update(sample_time=np.array([PID_SAMPLE_TIME]), limit=np.array([MAX_SPEED]))
+
+    start = time.perf_counter()
+    results = simulate(plant, step=step, duration=duration, **grid)
+    elapsed = time.perf_counter() - start
+    order, score = rank(results, overshoot_weight, effort_weight)
+    now = simulate(plant, step=step, duration=duration, **baseline)
+    print('%d combinations simulated in %.2f s, step of %g %s' % (len(order), elapsed, step, AXES[axis][2]))
+    print('%4s %9s %9s %9s %7s %5s %9s %9s %7s' %
+          ('', 'Kp', 'Ki', 'Kd', 'sample', 'limit', 'settling', 'overshoot', 'effort'))
+
+    def row(label, p, r, i):
+        print('%4s %9.4f %9.5f %9.5f %7.4f %5.0f %8.2fs %8.1f%% %7.1f' %
+              (label, p['kp'][i], p['ki'][i], p['kd'][i], p['sample_time'][i], p['limit'][i],
+               r['settling'][i], r['overshoot'][i] * 100, r['effort'][i]))
+
+    row('now', baseline, now, 0)
+    for n, i in enumerate(order[:top]):
+        if not np.isfinite(score[i]):
+            break
+        row(n + 1, grid, results, i)
+    best = order[0]
+    if np.isfinite(score[best]):
+        print("PID_GAINS['%s'] = (%.4g, %.4g, %.4g)" % (axis, grid['kp'][best], grid['ki'][best], grid['kd'][best]))
+
+
+if __name__ == '__main__':
+    arg_parse = argparse.ArgumentParser()
+    arg_parse.add_argument('--axis', choices=sorted(AXES), required=True, help='the controller in fly.py to tune')
+    arg_parse.add_argument('--plant', type=float, nargs=3, metavar=('GAIN', 'TIME_CONSTANT', 'DELAY'),
+                           help='the plant, instead of identifying it from a recording')
+    arg_parse.add_argument('--recording', help='a recording made with fly.py --record, to identify the plant from')
+    arg_parse.add_argument('--source', choices=('trace', 'telemetry'), default='trace',
+                           help='identify from the error trace in the video, or the telemetry')
+    arg_parse.add_argument('--step', type=float, help='initial error of the step response')
+    arg_parse.add_argument('--count', type=int, default=12, help='Kp values to try, and half as many Ki and Kd')
+    arg_parse.add_argument('--top', type=int, default=10, help='combinations to list')
+    arg_parse.add_argument('--duration', type=float, default=5.0, help='seconds of each step response')
+    arg_parse.add_argument('--overshoot-weight', type=float, default=2.0, help='seconds of settling per 100%% overshoot')
+    arg_parse.add_argument('--effort-weight', type=float, default=0.01, help='seconds of settling per stick second')
+    args = arg_parse.parse_args()
+    if not (args.plant or args.recording):
+        arg_parse.error('give --plant or --recording')
+    main(args.axis, Plant(*args.plant) if args.plant else None, args.recording, args.source, args.step, args.count,
+         args.top, args.duration, args.overshoot_weight, args.effort_weight)
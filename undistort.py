@@ -0,0 +1,78 @@
+"""
+Undistort points and frames through a lookup table, instead of OpenCV's iterative undistortion.
+
+The camera is calibrated with the 14 coefficient rational model, which has no closed form inverse, so every call
+to `cv2.undistortPoints` (and every pose estimate given the distortion coefficients) iterates to find where a
+point came from. `UndistortMap` does that once for every pixel of the sensor, and then undistorts any point by
+bilinear interpolation between the four pixels around it. It also holds the dense `cv2.remap` maps to undistort
+whole frames.
+
+The table depends only on the intrinsics, so it is cached on disk under CACHE_DIR, keyed by a hash of them, and
+only built again when the intrinsics change.
+"""
+
+import hashlib
+import os
+import cv2.cv2 as cv2
+import numpy as np
+from calibresults import camera_matrix, dist_coeff
+
+CAMERA_HEIGHT, CAMERA_WIDTH = 720, 960
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tello')
+UNDISTORT_CRITERIA = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 100, 1e-9)
+
+
+class UndistortMap:
+    """Undistorted position of every pixel, for a camera matrix and distortion coefficients.
+    Points are undistorted to pixels of the same camera matrix with no distortion, so they can be used with
+    `camera_matrix` and no distortion coefficients."""
+    def __init__(self, table, camera_matrix, dist_coeff, width=CAMERA_WIDTH, height=CAMERA_HEIGHT):
+        self.table = table  # (height, width, 2) undistorted (x, y) of each pixel
+        self.camera_matrix = camera_matrix
+        self.dist_coeff = dist_coeff
+        self.width = width
+        self.height = height
+        self._remap = None
+
+    @classmethod
+    def build(cls, camera_matrix=camera_matrix, dist_coeff=dist_coeff, width=CAMERA_WIDTH, height=CAMERA_HEIGHT):
+        """Undistort every pixel with OpenCV, once."""
+        x, y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        pixels = np.stack([x, y], axis=-1).reshape(-1, 1, 2)
+        table = cv2.undistortPointsIter(pixels, camera_matrix, dist_coeff, None, camera_matrix, UNDISTORT_CRITERIA)
+        return cls(np.ascontiguousarray(table.reshape(height, width, 2), dtype=np.float32), camera_matrix, dist_coeff, width, height)
+
+    @classmethod
+    def load(cls, camera_matrix=camera_matrix, dist_coeff=dist_coeff, width=CAMERA_WIDTH, height=CAMERA_HEIGHT,
+             cache_dir=CACHE_DIR):
+        """The map for these intrinsics, from the cache if it has been built before, else built and cached."""
+        key = hashlib.sha1()
+        for array in (camera_matrix, dist_coeff, np.array([width, height])):
+            key.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        path = os.path.join(cache_dir, 'undistort-%s.npy' % key.hexdigest()[:16])
+        try:
+            return cls(np.load(path), camera_matrix, dist_coeff, width, height)
+        except (OSError, ValueError):
+            pass
+        undistort_map = cls.build(camera_matrix, dist_coeff, width, height)
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary = path + '.%d.npy' % os.getpid()
+        np.save(temporary, undistort_map.table)
+        os.replace(temporary, path)  # Never leave a partly written table for another process to load
+        return undistort_map
+
+    def points(self, points):
+        """Undistort an array of (x, y) points of any shape (..., 2), by bilinear interpolation in the table.
+        The lookup is a `cv2.remap` of the table, which weights the four pixels in 1/32 pixel steps, so points are
+        within about 0.02 pixels of OpenCV's own undistortion. Points off the sensor are clamped to its edge."""
+        points = np.asarray(points, dtype=np.float32)
+        undistorted = cv2.remap(self.table, points.reshape(-1, 1, 2), None, cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_REPLICATE)
+        return undistorted.reshape(points.shape)
+
+    def remap(self, image):
+        """Undistort a whole frame, for display."""
+        if self._remap is None:
+            self._remap = cv2.initUndistortRectifyMap(self.camera_matrix, self.dist_coeff, None, self.camera_matrix,
+                                                      (self.width, self.height), cv2.CV_16SC2)
+        return cv2.remap(image, *self._remap, cv2.INTER_LINEAR)
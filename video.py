@@ -0,0 +1,211 @@
+"""
+Decode the drone's video off the control loop.
+
+The decoder runs in its own thread and keeps only the newest frame, so the
+control loop never acts on video that has queued up behind a slow frame.
+Frames are handed out as `Frame` adapters, so the detector can work straight
+off the decoded luma plane and a BGR copy is only made when something draws.
+
+The stream is opened as raw H.264 with a small probe and low delay
+decoding, and decoding starts at the first keyframe, so the first usable
+frame comes as soon as the drone sends one rather than after a fixed number
+of frames.
+
+In low latency mode the decoder is multi-threaded over the slices of a
+frame rather than over frames, which would hold frames back, and when
+frames arrive faster than the reader takes them, it skips decoding the
+frames nothing else is predicted from.
+"""
+
+import threading
+import time
+import av
+import numpy as np
+from metrics import span
+
+# Options for opening the drone's stream: the format is known, so read as little as possible before the first packet.
+# Not fflags nobuffer, which throws away the packets read while probing, and with them the first keyframe
+OPEN_OPTIONS = {'probesize': '32', 'analyzeduration': '0', 'flags': 'low_delay'}
+# Frames the decoder skips once the backlog reaches each level, most shed first. Only frames that no decoded frame
+# is predicted from are skipped, so every frame handed out is whole
+SHED_LEVELS = ((2.0, 'BIDIR'), (0.5, 'NONREF'))
+BACKLOG_SMOOTHING = 0.2  # Weight of the newest read in the smoothed backlog
+
+
+def open_video(stream, timeout=10.0):
+    """Open the raw H.264 `stream`, a file like object, with PyAV for low delay.
+    The drone may not be sending video yet, so opening is retried until `timeout` seconds have passed."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return av.open(stream, format='h264', options=OPEN_OPTIONS)
+        except av.AVError as ave:
+            if time.time() > deadline:
+                raise
+            print(ave)
+            print('retry...')
+            time.sleep(0.1)
+
+
+def keyframe_start(packets, metrics=None):
+    """Decode video `packets`, such as from `container.demux(video=0)`, from the first keyframe that decodes cleanly.
+    Packets before it are dropped without being decoded, and after a decode error packets are dropped again until
+    the next keyframe, so nothing predicted from missing or broken data is handed out.
+    Yields (packet, frame), with the packet whose decoding put out the frame. Each decode is timed as 'decode' in
+    `metrics`, if given, without the wait for the packets."""
+    synced = False
+    for packet in packets:
+        if not synced and not packet.is_keyframe:
+            continue
+        try:
+            with span(metrics, 'decode'):
+                frames = packet.decode()
+        except av.AVError:
+            synced = False
+            continue
+        synced = True  # Even if the decoder holds the keyframe back for reordering or its frame threads
+        for frame in frames:
+            yield packet, frame
+
+
+class Frame:
+    """A decoded PyAV video frame, with lazily built numpy images.
+    `record_time` is the time in a recording by which the frame had been read, when playing one back."""
+    def __init__(self, frame, record_time=None):
+        self.frame = frame
+        self.record_time = record_time
+        self.decode_time = time.time()
+        self.pts = frame.pts
+        self.time = frame.time
+        self.width = frame.width
+        self.height = frame.height
+        self._gray = None
+        self._bgr = None
+
+    @property
+    def gray(self):
+        """Grayscale image. For YUV frames this is a view of the decoded luma (Y) plane, no copy is made."""
+        if self._gray is None:
+            if self.frame.format.name.startswith(('yuv', 'yuvj', 'nv')):
+                plane = self.frame.planes[0]
+                rows = np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)
+                self._gray = rows[:self.height, :self.width]
+            else:
+                self._gray = self.frame.to_ndarray(format='gray')
+        return self._gray
+
+    @property
+    def bgr(self):
+        """BGR image for drawing on and display. Converted once, on first use."""
+        if self._bgr is None:
+            self._bgr = self.frame.to_ndarray(format='bgr24')
+        return self._bgr
+
+
+class FrameGrabber:
+    """Decode frames from a PyAV container in a background thread.
+
+    Only the latest decoded frame is kept. If a newer frame arrives before the
+    previous one was read, the previous one is dropped and counted. If
+    `lossless`, decoding instead waits for each frame to be read, e.g. to
+    replay a recording repeatably. Frames start at the first clean keyframe,
+    see `keyframe_start`.
+
+    If `low_latency`, the decoder uses slice threads only, and frames are shed
+    by the backlog: the smoothed number of frames that arrive each time one is
+    read, less the one read. As the backlog passes each of SHED_LEVELS the
+    decoder skips more frames, and frames are only ever handed out unconverted,
+    so a frame that is dropped costs no colour conversion either. Not with
+    `lossless`, which decodes every frame.
+
+    If given `stamp`, a function from a byte position in the stream to a
+    record time such as `recorder.ReplayDrone.stream_time`, each frame's
+    `record_time` is that of the last byte of the packet that put it out.
+    """
+    def __init__(self, container, lossless=False, metrics=None, low_latency=False, stamp=None):
+        self.container = container
+        self.stamp = stamp
+        self.metrics = metrics  # Times each decode
+        self.lossless = lossless
+        self.shed = low_latency and not lossless
+        self.codec = container.streams.video[0].codec_context
+        if low_latency:
+            self.codec.thread_type = 'SLICE'  # Frame threads would each hold a frame back
+            self.codec.thread_count = 0  # One per core
+        self.received = 0  # Packets, one per frame, whether decoded or not
+        self.decoded = 0
+        self.dropped = 0
+        self.backlog = 0.0
+        self.skip_frame = 'DEFAULT'  # The frames the decoder is skipping, as a PyAV skip_frame name
+        self._received_at_read = None
+        self._cond = threading.Condition()
+        self._frame = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='FrameGrabber', daemon=True)
+
+    def start(self):
+        """Start decoding. Returns self so it can be chained."""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop decoding after the current frame."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _run(self):
+        """Decode frames into the single frame slot until the stream ends."""
+        try:
+            frames = keyframe_start(self._packets(), self.metrics)
+            record_time = None  # Frames put out by the flush at the end keep the time of the last packet
+            while not self._stopped:
+                packet, frame = next(frames, (None, None))
+                if frame is None:
+                    break
+                self.decoded += 1
+                if self.stamp and packet.pos is not None and packet.pos >= 0:
+                    record_time = self.stamp(packet.pos + max(packet.size, 1) - 1)
+                with self._cond:
+                    while self.lossless and self._frame is not None and not self._stopped:
+                        self._cond.wait()
+                    if self._frame is not None:
+                        self.dropped += 1
+                    self._frame = Frame(frame, record_time)
+                    self._cond.notify()
+        finally:
+            self.stop()
+
+    def _packets(self):
+        """The video packets, counted as they arrive. If shedding, the decoder is set to skip the frames for the
+        backlog before each is decoded."""
+        for packet in self.container.demux(video=0):
+            if packet.size:
+                self.received += 1
+            if self.shed:
+                skip_frame = next((skip for level, skip in SHED_LEVELS if self.backlog >= level), 'DEFAULT')
+                if skip_frame != self.skip_frame:
+                    self.codec.skip_frame = self.skip_frame = skip_frame
+            yield packet
+
+    def read(self, timeout=None):
+        """Return the newest `Frame` not yet read, waiting up to `timeout` seconds for one.
+        Returns None on timeout or at the end of the stream."""
+        with self._cond:
+            if self._frame is None and not self._stopped:
+                self._cond.wait(timeout)
+            frame = self._frame
+            if frame is None:
+                return None
+            self._frame = None
+            if self._received_at_read is not None:
+                arrived = self.received - self._received_at_read
+                self.backlog += BACKLOG_SMOOTHING * (arrived - 1 - self.backlog)
+            self._received_at_read = self.received
+            self._cond.notify()
+        return frame
+
+    @property
+    def running(self):
+        """True until the stream ends or `stop` is called."""
+        return not self._stopped
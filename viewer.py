@@ -0,0 +1,282 @@
+"""
+Show, stream and record annotated frames from a separate process, so the flight loop never waits on a GUI or a disk.
+
+The flight loop hands each annotated frame to `Viewer.show`, which copies it in to a single slot of shared memory and
+returns. The slot is guarded by a sequence lock: the writer makes the sequence number odd while it copies and even
+when it is done, and the reader copies the frame out and keeps it only if the number was the same even number before
+and after. So neither side ever waits for the other, and the viewer only ever sees whole frames. Frames the viewer
+was too slow to pick up are overwritten.
+
+The viewer process can, in any combination:
+- show a downscaled preview window, and pass the keys pressed in it back to the flight loop (`Viewer.key`)
+- serve the preview as MJPEG on localhost, e.g. http://127.0.0.1:8080/
+- encode the frames to a video file with PyAV, through a bounded queue that drops frames when the encoder falls behind
+
+    viewer = Viewer(preview=True, mjpeg_port=8080, video_path='flight.mp4').start()
+    viewer.show(image)
+    key = viewer.key()
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+from fractions import Fraction
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+import av
+import cv2.cv2 as cv2
+import numpy as np
+
+HEADER_DTYPE = np.dtype([('sequence', '<u8'), ('height', '<u4'), ('width', '<u4'), ('time', '<f8')])
+MAX_HEIGHT, MAX_WIDTH = 720, 960
+POLL_PERIOD = 1/100  # Seconds between checks of the slot for a new frame
+BOUNDARY = b'frame'
+TIME_BASE = Fraction(1, 1000)
+
+
+class FrameSlot:
+    """One BGR frame in shared memory, written by one process and read by another under a sequence lock."""
+    def __init__(self, name=None, height=MAX_HEIGHT, width=MAX_WIDTH):
+        size = HEADER_DTYPE.itemsize + height * width * 3
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.header = np.ndarray((), HEADER_DTYPE, self.memory.buf)
+        self.pixels = np.ndarray(height * width * 3, np.uint8, self.memory.buf, HEADER_DTYPE.itemsize)
+        self.shape = (height, width)
+        if self.owner:
+            self.header['sequence'] = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, image):
+        """Copy a BGR image in to the slot. Images larger than the slot are cropped."""
+        image = image[:self.shape[0], :self.shape[1]]
+        height, width = image.shape[:2]
+        sequence = int(self.header['sequence'])
+        self.header['sequence'] = sequence + 1  # Odd: being written
+        self.header['height'], self.header['width'], self.header['time'] = height, width, time.time()
+        self.pixels[:height * width * 3].reshape(height, width, 3)[:] = image
+        self.header['sequence'] = sequence + 2  # Even: complete
+
+    def read(self, after=0):
+        """Return (sequence, time, image copy) of the frame in the slot if it is newer than sequence `after`,
+        or None if there is no newer whole frame to read yet."""
+        sequence = int(self.header['sequence'])
+        if sequence <= after or sequence % 2:
+            return None
+        height, width, t = int(self.header['height']), int(self.header['width']), float(self.header['time'])
+        image = self.pixels[:height * width * 3].reshape(height, width, 3).copy()
+        if int(self.header['sequence']) != sequence:
+            return None  # Overwritten while copying
+        return sequence, t, image
+
+    def close(self):
+        # Drop the numpy views first, or the memory cannot be closed
+        del self.header, self.pixels
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class Viewer:
+    """Start a viewer process, and pass it frames to show, stream or record."""
+    def __init__(self, preview=False, mjpeg_port=None, video_path=None, scale=0.5, queue_size=30):
+        self.options = {'preview': preview, 'mjpeg_port': mjpeg_port, 'video_path': video_path, 'scale': scale,
+                        'queue_size': queue_size}
+        self.slot = None
+        self.shown = 0
+        self._keys = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+        self._process = None
+
+    def start(self):
+        """Start the viewer process. Returns self so it can be chained."""
+        self.slot = FrameSlot()
+        self._process = multiprocessing.Process(target=run, name='Viewer', daemon=True,
+                                                args=(self.slot.name, self.slot.shape, self._keys, self._stop),
+                                                kwargs=self.options)
+        self._process.start()
+        return self
+
+    def show(self, image):
+        """Hand a BGR image to the viewer. Never waits."""
+        self.slot.write(image)
+        self.shown += 1
+
+    def key(self):
+        """The next key pressed in the preview window, as from cv2.waitKey, or 255 if none."""
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            return 255
+
+    def stop(self):
+        """Stop the viewer process, letting it finish the video file."""
+        if self._process is None:
+            return
+        self._stop.set()
+        self._process.join(5.0)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+        self.slot.close()
+
+
+class MjpegServer:
+    """Serve the latest JPEG as a multipart MJPEG stream on localhost."""
+    def __init__(self, port):
+        self._cond = threading.Condition()
+        self._jpeg = None
+        self._sequence = 0
+        self.closed = False
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % BOUNDARY.decode())
+                self.end_headers()
+                sequence = 0
+                try:
+                    while True:
+                        sequence, jpeg = server.wait(sequence)
+                        if server.closed:
+                            return
+                        if jpeg is None:
+                            continue
+                        self.wfile.write(b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+                                         % (BOUNDARY, len(jpeg)))
+                        self.wfile.write(jpeg + b'\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name='MjpegServer', daemon=True).start()
+
+    def publish(self, jpeg):
+        with self._cond:
+            self._jpeg = jpeg
+            self._sequence += 1
+            self._cond.notify_all()
+
+    def wait(self, sequence, timeout=1.0):
+        """Wait up to `timeout` seconds for a JPEG newer than `sequence`. Returns (sequence, jpeg)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._sequence != sequence, timeout)
+            return self._sequence, self._jpeg
+
+    def close(self):
+        self.closed = True
+        self.httpd.shutdown()
+        self.publish(None)
+
+
+class VideoWriter:
+    """Encode frames to a file with PyAV in a thread, from a bounded queue that drops frames when full."""
+    def __init__(self, path, size, queue_size=30, rate=30):
+        self.container = av.open(path, 'w')
+        self.stream = self.container.add_stream('h264', rate=rate)
+        self.stream.width, self.stream.height = size
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.codec_context.time_base = self.stream.time_base = TIME_BASE  # Frames are stamped in milliseconds
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._start = None
+        self._thread = threading.Thread(target=self._run, name='VideoWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, image, t):
+        """Queue a BGR image captured at wall time `t`, or drop it if the encoder is behind."""
+        try:
+            self._queue.put_nowait((image, t))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        last_pts = -1
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            image, t = item
+            if self._start is None:
+                self._start = t
+            frame = av.VideoFrame.from_ndarray(image, format='bgr24')
+            frame.time_base = TIME_BASE
+            frame.pts = last_pts = max(last_pts + 1, int((t - self._start) * 1000))  # Keep the real frame timing
+            for packet in self.stream.encode(frame):
+                self.container.mux(packet)
+        for packet in self.stream.encode():
+            self.container.mux(packet)
+        self.container.close()
+
+    def close(self):
+        """Encode what is queued and close the file."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def add_viewer_arguments(arg_parse):
+    """Add the command line options for headless running and the viewer."""
+    arg_parse.add_argument('--headless', action='store_true', help='open no window, e.g. on a companion computer')
+    arg_parse.add_argument('--preview', action='store_true', help='show a downscaled preview from the viewer process')
+    arg_parse.add_argument('--mjpeg', type=int, metavar='PORT', help='serve the preview as MJPEG on localhost:PORT')
+    arg_parse.add_argument('--save-video', metavar='PATH', help='encode the annotated video to this file')
+
+
+def make_viewer(args):
+    """The `Viewer` asked for by the options from `add_viewer_arguments`, or None."""
+    if args.preview or args.mjpeg or args.save_video:
+        return Viewer(preview=args.preview, mjpeg_port=args.mjpeg, video_path=args.save_video)
+    return None
+
+
+def run(slot_name, shape, keys, stop, preview=False, mjpeg_port=None, video_path=None, scale=0.5, queue_size=30):
+    """Viewer process: read frames from the slot until `stop` is set."""
+    slot = FrameSlot(slot_name, *shape)
+    server = MjpegServer(mjpeg_port) if mjpeg_port else None
+    writer = None
+    sequence = 0
+    try:
+        while not stop.is_set():
+            result = slot.read(sequence)
+            if result is None:
+                if preview:
+                    key = cv2.waitKey(int(POLL_PERIOD * 1000)) & 0xFF
+                    if key != 255:
+                        keys.put(key)
+                else:
+                    time.sleep(POLL_PERIOD)
+                continue
+            sequence, t, image = result
+            if video_path:
+                if writer is None:
+                    writer = VideoWriter(video_path, (image.shape[1], image.shape[0]), queue_size)
+                writer.write(image, t)
+            if not (preview or server):
+                continue
+            small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            if server:
+                server.publish(cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+            if preview:
+                cv2.imshow('Drone', small)
+                key = cv2.waitKey(1) & 0xFF
+                if key != 255:
+                    keys.put(key)
+    finally:
+        if writer:
+            writer.close()
+            if writer.dropped:
+                print('Viewer: dropped %d frames from the video, the encoder was too slow' % writer.dropped)
+        if server:
+            server.close()
+        if preview:
+            cv2.destroyAllWindows()
+        slot.close()